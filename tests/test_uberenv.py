@@ -0,0 +1,580 @@
+"""
+Unit tests of uberenv's helpers that need neither spack nor a network.
+
+Run from the repository root with:
+
+    python -m unittest discover -s tests
+"""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uberenv
+
+from os.path import join as pjoin
+
+
+def write_file(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+
+class OutputStreamTest(unittest.TestCase):
+
+    def test_lines_across_chunks(self):
+        parsed = []
+        stream = uberenv.OutputStream(quiet=True, parsers=[parsed.append])
+        stream.write("a\nb")
+        self.assertEqual(parsed, ["a"])
+        stream.write("c\nd")
+        self.assertEqual(parsed, ["a", "bc"])
+        stream.close()
+        self.assertEqual(parsed, ["a", "bc", "d"])
+        self.assertEqual(stream.output(), "a\nbc\nd")
+
+    def test_prints_complete_lines(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            stream = uberenv.OutputStream()
+            stream.write("first\nsec")
+            self.assertEqual(out.getvalue(), "first\n")
+            stream.write("ond\n")
+            self.assertEqual(out.getvalue(), "first\nsecond\n")
+
+    def test_tail_is_bounded(self):
+        parsed = []
+        with unittest.mock.patch.object(uberenv, "OUTPUT_TAIL_LINES", 3):
+            stream = uberenv.OutputStream(quiet=True, parsers=[parsed.append])
+        for i in range(10):
+            stream.write("line {0}\n".format(i))
+        stream.close()
+        self.assertEqual(len(parsed), 10)
+        self.assertEqual(stream.output(), "line 7\nline 8\nline 9\n")
+
+    def test_command_output(self):
+        script = "import sys\nfor i in range(3): print(i)\nsys.exit(2)"
+        parsed = []
+        res, out = uberenv.sexe_argv([sys.executable, "-c", script], ret_output=True,
+                                     parsers=[parsed.append])
+        self.assertEqual(res, 2)
+        self.assertEqual(out, "0\n1\n2\n")
+        self.assertEqual(parsed, ["0", "1", "2"])
+
+
+class StateTest(TempDirTestCase):
+
+    def test_roundtrip(self):
+        path = pjoin(self.tmp, ".uberenv_test.json")
+        uberenv.save_state(path, {"a": 1, "b": [1, 2]})
+        self.assertEqual(uberenv.load_state(path), {"a": 1, "b": [1, 2]})
+        self.assertEqual(os.listdir(self.tmp), [".uberenv_test.json"])
+
+    def test_missing_and_unreadable(self):
+        path = pjoin(self.tmp, ".uberenv_test.json")
+        self.assertIsNone(uberenv.load_state(path))
+        write_file(path, "{not json")
+        self.assertIsNone(uberenv.load_state(path))
+        write_file(path, "[1, 2]")
+        self.assertIsNone(uberenv.load_state(path))
+
+    def test_remove(self):
+        path = pjoin(self.tmp, ".uberenv_test.json")
+        uberenv.remove_state(path)
+        uberenv.save_state(path, {})
+        uberenv.remove_state(path)
+        self.assertFalse(os.path.exists(path))
+
+
+class ConcretizationCacheTest(TempDirTestCase):
+
+    def make_lock(self, name, content):
+        path = pjoin(self.tmp, name)
+        write_file(path, content)
+        return path
+
+    def test_store_and_restore(self):
+        cache = uberenv.ConcretizationCache(pjoin(self.tmp, "cache"), 1024)
+        dest = pjoin(self.tmp, "spack.lock")
+        self.assertFalse(cache.restore("a", dest))
+        self.assertFalse(os.path.exists(dest))
+        cache.store("a", self.make_lock("a.lock", "{\"a\": 1}"))
+        self.assertTrue(cache.restore("a", dest))
+        with open(dest) as f:
+            self.assertEqual(f.read(), "{\"a\": 1}")
+
+    def test_evicts_least_recently_used(self):
+        cache = uberenv.ConcretizationCache(pjoin(self.tmp, "cache"), 25)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cache.store("a", self.make_lock("a.lock", "0123456789"))
+            cache.store("b", self.make_lock("b.lock", "0123456789"))
+            os.utime(cache.entry_path("a"), (1000, 1000))
+            os.utime(cache.entry_path("b"), (2000, 2000))
+            # a restore marks a as used, b is now the oldest
+            self.assertTrue(cache.restore("a", pjoin(self.tmp, "spack.lock")))
+            cache.store("c", self.make_lock("c.lock", "0123456789"))
+        self.assertTrue(os.path.isfile(cache.entry_path("a")))
+        self.assertFalse(os.path.isfile(cache.entry_path("b")))
+        self.assertTrue(os.path.isfile(cache.entry_path("c")))
+
+
+class PackagePyDependenciesTest(unittest.TestCase):
+
+    def test_depends_on_extends_and_imports(self):
+        content = "\n".join([
+            "from spack_repo.builtin.packages.cmake.package import CMake",
+            "class Foo(CMakePackage):",
+            "    extends('python')",
+            "    depends_on(\"mpi\", when=\"+mpi\")",
+            "    depends_on(",
+            "        'hdf5+hl@1.10:')",
+            "    depends_on('py-numpy', type=('build', 'run'))",
+            "    conflicts('%gcc@:4')",
+        ])
+        self.assertEqual(uberenv.package_py_dependencies(content),
+                         ["python", "mpi", "hdf5", "py-numpy", "cmake"])
+
+    def test_nothing(self):
+        self.assertEqual(uberenv.package_py_dependencies("class Foo(Package):\n    pass\n"), [])
+
+
+class SpecPackageNamesTest(unittest.TestCase):
+
+    def test_compilers_and_dependencies(self):
+        self.assertEqual(uberenv.spec_package_names("@1.0.0%gcc@10 ^hdf5+hl ^ mpich"),
+                         ["gcc", "hdf5", "mpich"])
+        self.assertEqual(uberenv.spec_package_names("+cuda %c=clang %cxx=gcc"), ["clang", "gcc"])
+        self.assertEqual(uberenv.spec_package_names("@develop+mpi"), [])
+
+
+class ReadGitTest(TempDirTestCase):
+
+    sha1 = "1" * 40
+    sha2 = "2" * 40
+
+    def make_repo(self, head):
+        repo = pjoin(self.tmp, "repo")
+        write_file(pjoin(repo, ".git", "HEAD"), head + "\n")
+        return repo
+
+    def test_branch(self):
+        repo = self.make_repo("ref: refs/heads/develop")
+        write_file(pjoin(repo, ".git", "refs", "heads", "develop"), self.sha1 + "\n")
+        self.assertEqual(uberenv.read_git_head(repo), self.sha1)
+        self.assertEqual(uberenv.read_git_branch(repo), "develop")
+
+    def test_packed_ref(self):
+        repo = self.make_repo("ref: refs/heads/main")
+        write_file(pjoin(repo, ".git", "packed-refs"),
+                   "# pack-refs with: peeled fully-peeled sorted\n"
+                   "{0} refs/heads/main\n{1} refs/tags/v1.0\n".format(self.sha1, self.sha2))
+        self.assertEqual(uberenv.read_git_head(repo), self.sha1)
+        self.assertEqual(uberenv.resolve_git_ref(pjoin(repo, ".git"), "refs/tags/v1.0"), self.sha2)
+
+    def test_detached(self):
+        repo = self.make_repo(self.sha2)
+        self.assertEqual(uberenv.read_git_head(repo), self.sha2)
+        self.assertIsNone(uberenv.read_git_branch(repo))
+
+    def test_worktree(self):
+        common = pjoin(self.tmp, "store.git")
+        git_dir = pjoin(common, "worktrees", "spack")
+        write_file(pjoin(common, "refs", "heads", "feature"), self.sha1 + "\n")
+        write_file(pjoin(git_dir, "HEAD"), "ref: refs/heads/feature\n")
+        write_file(pjoin(git_dir, "commondir"), "../..\n")
+        worktree = pjoin(self.tmp, "spack")
+        write_file(pjoin(worktree, ".git"), "gitdir: {0}\n".format(git_dir))
+        self.assertEqual(uberenv.read_git_head(worktree), self.sha1)
+        self.assertEqual(uberenv.read_git_branch(worktree), "feature")
+
+    def test_not_a_repo(self):
+        self.assertIsNone(uberenv.read_git_head(self.tmp))
+        self.assertIsNone(uberenv.read_git_branch(self.tmp))
+
+
+class InputsHashTest(TempDirTestCase):
+
+    def make_env(self):
+        env = object.__new__(uberenv.SpackEnv)
+        env.project_json = pjoin(self.tmp, "project.json")
+        write_file(env.project_json, '{"package_name": "foo"}')
+        env.project_args = {"package_name": "foo",
+                            "spack_commit": "abc",
+                            "spack_build_mode": "install"}
+        env.args = dict((key, None) for key in env.install_manifest_args)
+        env.args.update({"ignore_ssl_errors": False, "mirror": None})
+        env.spack_root = None
+        env.spack_env_file = None
+        env.spack_configs_path = pjoin(self.tmp, "configs")
+        env.packages_paths = [pjoin(self.tmp, "packages")]
+        write_file(pjoin(self.tmp, "packages", "foo", "package.py"), "class Foo: pass\n")
+        env.dest_dir = pjoin(self.tmp, "prefix")
+        env.dest_spack = pjoin(env.dest_dir, "spack")
+        return env
+
+    def test_install_inputs_hash(self):
+        env = self.make_env()
+        before = env.install_inputs_hash()
+        self.assertEqual(env.install_inputs_hash(), before)
+        env.args["spec"] = "@1.0"
+        changed_arg = env.install_inputs_hash()
+        self.assertNotEqual(changed_arg, before)
+        write_file(pjoin(self.tmp, "packages", "foo", "package.py"), "class Foo: version = 2\n")
+        self.assertNotEqual(env.install_inputs_hash(), changed_arg)
+
+    def test_install_inputs_hash_checkouts(self):
+        env = self.make_env()
+        without = env.install_inputs_hash(include_checkouts=False)
+        with_checkouts = env.install_inputs_hash()
+        write_file(pjoin(env.dest_spack, ".git", "HEAD"), "1" * 40 + "\n")
+        self.assertEqual(env.install_inputs_hash(include_checkouts=False), without)
+        self.assertNotEqual(env.install_inputs_hash(), with_checkouts)
+
+    def test_install_is_current_dependencies(self):
+        env = self.make_env()
+        env.pkg_name = "foo"
+        env.spec_hash = "abc"
+        env.install_prefix = None
+        env.host_config_path = pjoin(self.tmp, "prefix", "host.cmake")
+        write_file(env.host_config_path, "# host-config\n")
+        tpl_prefix = pjoin(self.tmp, "tpls", "bar")
+        os.makedirs(tpl_prefix)
+        env.tpl_prefixes = [tpl_prefix]
+        env.write_install_manifest()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(env.install_is_current())
+            os.rmdir(tpl_prefix)
+            self.assertFalse(env.install_is_current())
+
+    def test_setup_inputs_hash(self):
+        env = self.make_env()
+        before = env.setup_inputs_hash()
+        env.project_args["spack_build_mode"] = "dev-build"
+        self.assertEqual(env.setup_inputs_hash(), before)
+        env.project_args["spack_commit"] = "def"
+        self.assertNotEqual(env.setup_inputs_hash(), before)
+
+    def test_phase_inputs_hash(self):
+        env = self.make_env()
+        before = env.phase_inputs_hash()
+        write_file(pjoin(env.dest_spack, ".git", "HEAD"), "1" * 40 + "\n")
+        self.assertEqual(env.phase_inputs_hash(), before)
+        env.args["mirror"] = "/mirror"
+        self.assertNotEqual(env.phase_inputs_hash(), before)
+
+    def test_clean_build_inputs(self):
+        env = self.make_env()
+        before = env.clean_build_inputs()
+        self.assertEqual(before["spack"], "None")
+        write_file(pjoin(self.tmp, "packages", "foo", "package.py"), "class Foo: version = 2\n")
+        after = env.clean_build_inputs()
+        self.assertNotEqual(after["packages"], before["packages"])
+        self.assertEqual(after["builtin"], before["builtin"])
+
+
+class PhaseGraphTest(TempDirTestCase):
+
+    def run_graph(self, funcs, deps, resume=False, keys=None, checkpoint=True, exists=None):
+        ran = []
+        def phase_func(name):
+            def func():
+                ran.append(name)
+                return funcs.get(name)
+            return func
+        phases = [uberenv.Phase(name, phase_func(name), inputs=deps.get(name, ()),
+                                checkpoint=checkpoint,
+                                key=(keys or {}).get(name),
+                                exists=(exists or {}).get(name))
+                  for name in ["a", "b", "c", "d"]]
+        state = uberenv.PhaseState(pjoin(self.tmp, ".uberenv_phases.json"))
+        graph = uberenv.PhaseGraph(phases, max_workers=2, state=state,
+                                   inputs_hash="inputs", resume=resume)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = graph.run()
+        return ran, results
+
+    deps = {"b": ["a"], "c": ["a"], "d": ["b", "c"]}
+
+    def test_order(self):
+        ran, results = self.run_graph({"d": 3}, self.deps)
+        self.assertEqual(ran[0], "a")
+        self.assertEqual(set(ran[1:3]), set(["b", "c"]))
+        self.assertEqual(ran[3], "d")
+        self.assertEqual(results["d"], 3)
+
+    def test_resume_skips_completed(self):
+        # d fails, everything before it is recorded as complete
+        self.run_graph({"d": 1}, self.deps)
+        ran, _ = self.run_graph({}, self.deps, resume=True)
+        self.assertEqual(ran, ["d"])
+        ran, _ = self.run_graph({}, self.deps, resume=True)
+        self.assertEqual(ran, [])
+
+    def test_resume_reruns_changed_and_dependents(self):
+        self.run_graph({}, self.deps, keys={"b": lambda: "1"})
+        ran, _ = self.run_graph({}, self.deps, resume=True, keys={"b": lambda: "2"})
+        self.assertEqual(ran, ["b", "d"])
+
+    def test_resume_reruns_when_output_is_gone(self):
+        self.run_graph({}, self.deps)
+        ran, _ = self.run_graph({}, self.deps, resume=True, exists={"c": lambda: False})
+        self.assertEqual(ran, ["c", "d"])
+
+    def test_incomplete_is_not_recorded(self):
+        self.run_graph({"b": uberenv.Phase.INCOMPLETE}, self.deps)
+        ran, _ = self.run_graph({}, self.deps, resume=True)
+        self.assertEqual(ran, ["b", "d"])
+
+    def test_without_resume_all_run(self):
+        self.run_graph({}, self.deps)
+        ran, _ = self.run_graph({}, self.deps)
+        self.assertEqual(sorted(ran), ["a", "b", "c", "d"])
+
+    def test_missing_input(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                uberenv.PhaseGraph([uberenv.Phase("a", lambda: None, inputs=["x"])])
+
+    def test_cycle(self):
+        phases = [uberenv.Phase("a", lambda: None, inputs=["b"]),
+                  uberenv.Phase("b", lambda: None, inputs=["a"])]
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                uberenv.PhaseGraph(phases).run()
+
+    def test_state_file(self):
+        self.run_graph({}, self.deps)
+        completed = json.load(open(pjoin(self.tmp, ".uberenv_phases.json")))["completed"]
+        self.assertEqual(sorted(completed), ["a", "b", "c", "d"])
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_lanes(self):
+        tracer = uberenv.Tracer()
+        tracer.path = "unused"
+        started = threading.Barrier(3)
+        def command(name):
+            with tracer.span(name, "command"):
+                started.wait()
+        with tracer.span("phase", "phase"):
+            with tracer.span("nested", "command"):
+                pass
+            threads = [threading.Thread(target=command, args=(name,)) for name in ("a", "b", "c")]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        lanes = dict((e["name"], e["tid"]) for e in tracer.events)
+        self.assertEqual(lanes["nested"], lanes["phase"])
+        # overlapping spans each get their own lane
+        self.assertEqual(len(set(lanes[n] for n in ("phase", "a", "b", "c"))), 4)
+        # and free lanes are reused
+        with tracer.span("later", "phase"):
+            pass
+        self.assertEqual(tracer.events[-1]["tid"], lanes["phase"])
+
+
+class SplitShardsTest(unittest.TestCase):
+
+    def test_round_robin(self):
+        self.assertEqual(uberenv.split_shards(["a", "b", "c", "d", "e"], 2),
+                         [["a", "c", "e"], ["b", "d"]])
+
+    def test_fewer_items_than_shards(self):
+        self.assertEqual(uberenv.split_shards(["a", "b"], 8), [["a"], ["b"]])
+        self.assertEqual(uberenv.split_shards([], 4), [])
+
+    def test_keeps_every_item_once(self):
+        items = ["pkg{0}".format(i) for i in range(23)]
+        shards = uberenv.split_shards(items, 5)
+        self.assertEqual(len(shards), 5)
+        self.assertEqual(sorted(sum(shards, [])), sorted(items))
+
+
+class ExecutablesFingerprintTest(TempDirTestCase):
+
+    def make_exe(self, d, name):
+        path = pjoin(self.tmp, d, name)
+        write_file(path, "#!/bin/sh\n")
+        os.chmod(path, 0o755)
+        return path
+
+    def test_resolved_executables(self):
+        first = pjoin(self.tmp, "a")
+        second = pjoin(self.tmp, "b")
+        self.make_exe("b", "gcc")
+        before = uberenv.executables_fingerprint(["gcc"], [first, second])
+        self.assertIn(pjoin(second, "gcc"), before)
+        # an unrelated file does not change it
+        self.make_exe("a", "other")
+        self.assertEqual(uberenv.executables_fingerprint(["gcc"], [first, second]), before)
+        # a gcc earlier in PATH does
+        self.make_exe("a", "gcc")
+        self.assertNotEqual(uberenv.executables_fingerprint(["gcc"], [first, second]), before)
+
+    def test_missing_and_dirs(self):
+        d = pjoin(self.tmp, "a")
+        os.makedirs(d)
+        self.assertEqual(uberenv.executables_fingerprint(["gcc"], [d]),
+                         "dirs: {0}\ngcc: -".format(d))
+        self.assertNotEqual(uberenv.executables_fingerprint(["gcc"], [d, self.tmp]),
+                            uberenv.executables_fingerprint(["gcc"], [d]))
+
+
+class BootstrapStateTest(TempDirTestCase):
+
+    def make_env(self, prefix, bootstrap_yaml):
+        env = object.__new__(uberenv.SpackEnv)
+        env.spack_root = None
+        env.dest_spack = pjoin(self.tmp, prefix, "spack")
+        env.spack_bootstrap_root = pjoin(self.tmp, "bootstrap")
+        env.spack_bootstrap_mirror = None
+        write_file(pjoin(env.dest_spack, "etc", "spack", "defaults", "bootstrap.yaml"), bootstrap_yaml)
+        return env
+
+    def test_same_config_in_other_prefix(self):
+        first = self.make_env("p1", "bootstrap:\n  enable: true\n")
+        second = self.make_env("p2", "bootstrap:\n  enable: true\n")
+        self.assertEqual(first.bootstrap_state(), second.bootstrap_state())
+
+    def test_changed_config(self):
+        first = self.make_env("p1", "bootstrap:\n  enable: true\n")
+        second = self.make_env("p2", "bootstrap:\n  enable: false\n")
+        self.assertNotEqual(first.bootstrap_state(), second.bootstrap_state())
+
+
+class DisableSpackConfigScopesTest(TempDirTestCase):
+
+    old_scopes = ("config_scopes = [\n"
+                  "    ('system', os.path.join(spack.paths.system_etc_path, 'spack')),\n"
+                  "    ('site', os.path.join(spack.paths.etc_path, 'spack')),\n"
+                  "    ('user', spack.paths.user_config_path)\n"
+                  "]\n")
+
+    def disable(self, content):
+        env = object.__new__(uberenv.SpackEnv)
+        env.spack_root = None
+        env.dest_spack = self.tmp
+        env.stop_spack_session = lambda: None
+        config_py = pjoin(self.tmp, "lib", "spack", "spack", "config.py")
+        write_file(config_py, content)
+        out = io.StringIO()
+        with unittest.mock.patch.dict(os.environ), contextlib.redirect_stdout(out):
+            os.environ.pop("SPACK_DISABLE_LOCAL_CONFIG", None)
+            env.disable_spack_config_scopes()
+            disabled = os.environ.get("SPACK_DISABLE_LOCAL_CONFIG")
+        with open(config_py) as f:
+            return f.read(), out.getvalue(), disabled
+
+    def test_env_var(self):
+        content = uberenv.SpackEnv.spack_disable_env_stmt + "\n"
+        patched, out, disabled = self.disable(content)
+        self.assertEqual(patched, content)
+        self.assertEqual(disabled, "1")
+
+    def test_old_scopes(self):
+        patched, out, disabled = self.disable(self.old_scopes)
+        self.assertEqual(patched.count("#DISABLED BY UBERENV: "), 3)
+        again, out, disabled = self.disable(patched)
+        self.assertEqual(again, patched)
+        self.assertIn("[config.py is already patched]", out)
+
+    def test_unknown_layout(self):
+        patched, out, disabled = self.disable("config_scopes = []\n")
+        self.assertEqual(patched, "config_scopes = []\n")
+        self.assertNotIn("already patched", out)
+        self.assertIn("[WARNING: Could not disable", out)
+        self.assertEqual(disabled, "1")
+
+
+class RunCommandsTest(unittest.TestCase):
+
+    def make_env(self, jobs=None):
+        env = object.__new__(uberenv.UberEnv)
+        env.args = {"uberenv_jobs": jobs}
+        return env
+
+    def test_default_jobs_capped(self):
+        env = self.make_env()
+        with unittest.mock.patch("os.cpu_count", return_value=64):
+            self.assertEqual(env.uberenv_jobs(), 8)
+        with unittest.mock.patch("os.cpu_count", return_value=None):
+            self.assertEqual(env.uberenv_jobs(), 1)
+
+    def test_explicit_jobs(self):
+        with unittest.mock.patch("os.cpu_count", return_value=2):
+            self.assertEqual(self.make_env(32).uberenv_jobs(), 32)
+
+    def test_done_as_completed(self):
+        env = self.make_env(2)
+        fast_done = threading.Event()
+        def run_one_command(argv):
+            if argv == "slow":
+                fast_done.wait(5)
+            return argv
+        env.run_one_command = run_one_command
+        finished = []
+        def done(i, result):
+            finished.append(i)
+            fast_done.set()
+        results = env.run_commands([{"argv": "slow"}, {"argv": "fast"}], done=done)
+        self.assertEqual(results, ["slow", "fast"])
+        self.assertEqual(finished, [1, 0])
+
+    def test_probe_spack_commands(self):
+        env = object.__new__(uberenv.SpackEnv)
+        env.args = {"uberenv_jobs": 3, "spack_debug": False}
+        env.dest_spack = "/spack"
+        outputs = {"python": "/usr/bin/python3\n",
+                   "--version": "0.22.0\n",
+                   "help": "  --fresh  ...\n"}
+        env.run_one_command = lambda argv, **kwargs: (0, outputs[argv[1]])
+        self.assertEqual(env.probe_spack_commands(),
+                         {"python": "/usr/bin/python3", "version": "0.22.0\n",
+                          "fresh": True, "reuse": False})
+
+    def test_vcpkg_show_info(self):
+        env = object.__new__(uberenv.VcpkgEnv)
+        env.args = {"uberenv_jobs": 2}
+        env.pkg_name = "foo"
+        env.dest_vcpkg = os.getcwd()
+        def run_one_command(argv, echo=False, ret_output=False):
+            if ret_output:
+                return 0, "foo depends on bar\n"
+            print("foo 1.0")
+            return 0
+        env.run_one_command = run_one_command
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            env.show_info()
+        self.assertEqual(out.getvalue().splitlines(),
+                         ["[info: Details for package 'foo']",
+                          "foo 1.0",
+                          "[info: Dependencies for package 'foo']",
+                          "[exe: vcpkg.exe depend-info foo]",
+                          "foo depends on bar"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -62,6 +62,24 @@ import json
 import glob
 import re
 import argparse
+import shlex
+import atexit
+import threading
+import queue
+import concurrent.futures
+import hashlib
+import collections
+import contextlib
+import time
+import keyword
+import io
+import tarfile
+
+try:
+    import fcntl
+except ImportError:
+    # windows, shared directories are used without locking
+    fcntl = None
 
 from functools import partial
 
@@ -73,20 +91,345 @@ from os.path import abspath as pabs
 # order.
 print = partial(print, flush=True)
 
-def sexe(cmd,ret_output=False,echo=False):
-    """ Helper for executing shell commands. """
+class Tracer():
+    """
+    Records timed spans (phases and commands) and writes them as Chrome
+    trace-event json (see --trace), which Perfetto and chrome://tracing
+    can load. Does nothing until a path is set.
+
+    Spans are recorded in lanes (trace-event tids) rather than per thread:
+    a span nests in the lane of the span its thread has open, otherwise it
+    takes the lowest lane no open span uses, so spans overlapping in time
+    never share a lane.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self.lock = threading.Lock()
+        self.busy_lanes = set()
+        self.local = threading.local()
+
+    def open(self, path):
+        self.path = path
+        atexit.register(self.write)
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        """
+        Context manager recording one span, values added to the yielded
+        dict (e.g. the return code) end up in the span's args.
+        """
+        if self.path is None:
+            yield {}
+            return
+        lanes = self.local.__dict__.setdefault("lanes", [])
+        if lanes:
+            lane = lanes[-1]
+        else:
+            with self.lock:
+                lane = 1
+                while lane in self.busy_lanes:
+                    lane += 1
+                self.busy_lanes.add(lane)
+        lanes.append(lane)
+        begin = time.time()
+        try:
+            yield args
+        finally:
+            end = time.time()
+            lanes.pop()
+            event = {"name": name,
+                     "cat": cat,
+                     "ph": "X",
+                     "ts": int(begin * 1e6),
+                     "dur": int((end - begin) * 1e6),
+                     "pid": os.getpid(),
+                     "tid": lane,
+                     "args": args}
+            with self.lock:
+                if not lanes:
+                    self.busy_lanes.discard(lane)
+                self.events.append(event)
+
+    def write(self):
+        if self.path is None:
+            return
+        # name the lanes after what ran in them
+        with self.lock:
+            events = list(self.events)
+        lanes = {}
+        for event in events:
+            cats = lanes.setdefault(event["tid"], set())
+            cats.add(event["cat"])
+        for tid, cats in lanes.items():
+            kind = "uberenv" if "run" in cats else "phases" if "phase" in cats else "commands"
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                           "tid": tid, "args": {"name": "{0} {1}".format(kind, tid)}})
+            events.append({"name": "thread_sort_index", "ph": "M", "pid": os.getpid(),
+                           "tid": tid, "args": {"sort_index": tid}})
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print("[trace written to {0}]".format(self.path))
+
+
+# Records phase and command timings (see --trace)
+tracer = Tracer()
+
+
+def command_span_name(argv):
+    """
+    Short name for a command span: the executable and its first
+    non-option argument (e.g. "spack install").
+    """
+    name = [os.path.basename(argv[0])] if argv else []
+    args = argv[1:]
+    while args:
+        if args[0] in ("-D", "-C", "-e", "-c"):
+            args = args[2:]
+        elif args[0].startswith("-"):
+            args = args[1:]
+        else:
+            name.append(args[0])
+            break
+    if len(name) == 1 and len(argv) > 1:
+        # only options, e.g. "spack --version"
+        name.append(argv[-1])
+    return " ".join(name)
+
+
+# Log file all command output is copied to (see --log)
+uberenv_log = None
+uberenv_log_lock = threading.Lock()
+
+# Number of lines of a command's output kept for ret_output
+OUTPUT_TAIL_LINES = 10000
+
+
+def open_log(path):
+    """ Starts copying the output of all commands to the given file. """
+    global uberenv_log
+    uberenv_log = open(path, "a", encoding="utf8")
+    atexit.register(uberenv_log.close)
+
+
+def write_log(text):
+    if uberenv_log is not None:
+        with uberenv_log_lock:
+            uberenv_log.write(text)
+            uberenv_log.flush()
+
+
+class OutputStream():
+    """
+    Receives the output of a command as it arrives.
+
+    Complete lines are printed (unless quiet), copied to the log and passed
+    to each of the parsers. Only the last OUTPUT_TAIL_LINES lines are kept
+    in memory, so large outputs (e.g. with --spack-debug) do not pile up.
+    """
+
+    def __init__(self, quiet=False, parsers=()):
+        self.quiet = quiet
+        self.parsers = list(parsers)
+        self.tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+        self.partial = ""
+
+    def write(self, data):
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line + "\n")
+
+    def line(self, line):
+        if not self.quiet:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        write_log(line)
+        self.tail.append(line)
+        for parser in self.parsers:
+            parser(line.rstrip("\n"))
+
+    def close(self):
+        if self.partial:
+            self.line(self.partial)
+            self.partial = ""
+
+    def output(self):
+        return "".join(self.tail)
+
+
+class CurrentPhase(threading.local):
+    """ Name of the phase the current thread runs, commands are accounted to it. """
+    name = "uberenv"
+
+
+current_phase = CurrentPhase()
+
+
+class ResourceUsage():
+    """
+    Adds up the resources (from os.wait4) used by the commands of each
+    phase, for the table printed when uberenv exits.
+    """
+
+    fields = ("utime", "stime", "maxrss", "inblock", "oublock", "nvcsw", "nivcsw")
+
+    def __init__(self):
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def add(self, usage):
+        with self.lock:
+            totals = self.phases.setdefault(current_phase.name,
+                                            dict([("commands", 0)] + [(f, 0) for f in self.fields]))
+            totals["commands"] += 1
+            for f in self.fields:
+                if f == "maxrss":
+                    totals[f] = max(totals[f], usage[f])
+                else:
+                    totals[f] += usage[f]
+
+    def report(self, path):
+        """
+        Prints the per phase table and writes it to the json file at path.
+        """
+        with self.lock:
+            phases = dict(self.phases)
+        if not phases:
+            return
+        print("[resource usage of commands per phase (max rss is the largest single command):]")
+        row = "  {0:<30} {1:>5} {2:>10} {3:>10} {4:>12} {5:>10} {6:>10} {7:>10} {8:>10}"
+        print(row.format("phase", "cmds", "user (s)", "sys (s)", "max rss (MB)",
+                         "blk in", "blk out", "ctx vol", "ctx invol"))
+        for name, t in phases.items():
+            print(row.format(name, t["commands"],
+                             "{0:.1f}".format(t["utime"]), "{0:.1f}".format(t["stime"]),
+                             "{0:.1f}".format(t["maxrss"] / 1024.0),
+                             t["inblock"], t["oublock"], t["nvcsw"], t["nivcsw"]))
+        try:
+            with open(path, "w") as f:
+                json.dump(phases, f, indent=2)
+            print("[resource usage written to {0}]".format(path))
+        except OSError as e:
+            print("[WARNING: Failed to write resource usage to {0}: {1}]".format(path, e))
+
+
+# Resources used by all commands uberenv ran
+resource_usage = ResourceUsage()
+
+
+def rusage_dict(ru):
+    """ The fields of a resource.struct_rusage uberenv reports. """
+    maxrss = ru.ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on macOS, KB elsewhere
+        maxrss = maxrss // 1024
+    return {"utime": ru.ru_utime,
+            "stime": ru.ru_stime,
+            "maxrss": maxrss,
+            "inblock": ru.ru_inblock,
+            "oublock": ru.ru_oublock,
+            "nvcsw": ru.ru_nvcsw,
+            "nivcsw": ru.ru_nivcsw}
+
+
+def wait_child(p):
+    """
+    Waits for the subprocess.Popen p and returns its return code. Where
+    os.wait4 exists, also returns the resources it (and the children it
+    waited for) used, otherwise None.
+    """
+    if not hasattr(os, "wait4"):
+        return p.wait(), None
+    while True:
+        try:
+            _, status, ru = os.wait4(p.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    if os.WIFEXITED(status):
+        p.returncode = os.WEXITSTATUS(status)
+    else:
+        p.returncode = -os.WTERMSIG(status)
+    return p.returncode, rusage_dict(ru)
+
+
+def join_argv(argv):
+    """ Returns argv as one shell-escaped string (shlex.join needs python 3.8). """
+    return " ".join(shlex.quote(arg) for arg in argv)
+
+
+def run_command(cmd, shell=True, ret_output=False, parsers=(), env=None):
+    """
+    Runs cmd (a shell command, or an argv list when shell is False) and
+    records its span and resource usage. Returns (returncode, output),
+    output is None unless ret_output.
+    """
+    if shell:
+        name, cmd_str = command_span_name(cmd.split()), cmd
+    else:
+        name, cmd_str = command_span_name(cmd), join_argv(cmd)
+    piped = ret_output or parsers or uberenv_log is not None
+    with tracer.span(name, "command", cmd=cmd_str) as span:
+        # unless needed, output goes straight to the terminal
+        p = subprocess.Popen(cmd,
+                             shell=shell,
+                             env=env,
+                             stdout=subprocess.PIPE if piped else None,
+                             stderr=subprocess.STDOUT if piped else None)
+        stream = None
+        if piped:
+            stream = OutputStream(quiet=ret_output, parsers=parsers)
+            for line in iter(p.stdout.readline, b""):
+                stream.write(line.decode("utf8", errors="replace"))
+            stream.close()
+            p.stdout.close()
+        rc, usage = wait_child(p)
+        span["rc"] = rc
+        if usage is not None:
+            span.update(usage)
+            resource_usage.add(usage)
+    return rc, stream.output() if ret_output else None
+
+
+def sexe(cmd,ret_output=False,echo=False,parsers=()):
+    """
+    Helper for executing shell commands.
+
+    With ret_output, returns (returncode, output) where output holds the
+    last OUTPUT_TAIL_LINES lines. parsers are called with each line of
+    output as it arrives.
+    """
     if echo:
         print("[exe: {0}]".format(cmd))
+        write_log("[exe: {0}]\n".format(cmd))
+    rc, out = run_command(cmd, ret_output=ret_output, parsers=parsers)
     if ret_output:
-        p = subprocess.Popen(cmd,
-                             shell=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        out = p.communicate()[0]
-        out = out.decode('utf8')
-        return p.returncode,out
-    else:
-        return subprocess.call(cmd,shell=True)
+        return rc,out
+    return rc
+
+
+def sexe_argv(argv, ret_output=False, echo=False, env=None, parsers=()):
+    """
+    Runs a command given as an argv list (no shell), used for commands
+    run concurrently by run_commands.
+
+    env holds variables set on top of os.environ for this command only.
+    Returns the same as sexe.
+    """
+    if echo:
+        print("[exe: {0}]".format(join_argv(argv)))
+        write_log("[exe: {0}]\n".format(join_argv(argv)))
+    cmd_env = None
+    if env:
+        cmd_env = dict(os.environ)
+        cmd_env.update(env)
+    rc, out = run_command(argv, shell=False, ret_output=ret_output,
+                          parsers=parsers, env=cmd_env)
+    if ret_output:
+        return rc,out
+    return rc
 
 
 def parse_args():
@@ -168,6 +511,14 @@ def parse_args():
                       default=False,
                       help="add debug option to all spack commands")
 
+    # run spack commands through one long-lived spack python worker
+    parser.add_argument("--spack-session",
+                      dest="spack_session",
+                      action="store_true",
+                      default=False,
+                      help="run spack commands through a persistent 'spack python' "
+                           "worker instead of starting spack for every command")
+
     # spack allow deprecated packages
     parser.add_argument("--spack-allow-deprecated",
                       dest="spack_allow_deprecated",
@@ -222,6 +573,53 @@ def parse_args():
                       default=False,
                       help="Force uninstall of packages specified in project.json")
 
+    # partial clone of the builtin packages repo
+    parser.add_argument("--spack-packages-sparse",
+                      action="store_true",
+                      dest="spack_packages_sparse",
+                      default=False,
+                      help="Partially clone the builtin spack-packages repo, with only the packages needed to concretize")
+
+    # option to wipe all spack caches, even when their inputs are unchanged
+    parser.add_argument("--clean-caches",
+                      action="store_true",
+                      dest="clean_caches",
+                      default=False,
+                      help="Always clean spack's misc and python caches, not only when spack or the package repos changed")
+
+    # option to ignore the install manifest written by a previous run
+    parser.add_argument("--force",
+                      action="store_true",
+                      dest="force",
+                      default=False,
+                      help="Run all steps, even if the host-config from a previous run is still current")
+
+    # option to skip phases completed by a previous run with the same inputs
+    parser.add_argument("--resume",
+                      action="store_true",
+                      dest="resume",
+                      default=False,
+                      help="Skip setup phases a previous (failed) run already completed with the same inputs")
+
+    # record a timing trace
+    parser.add_argument("--trace",
+                      dest="trace",
+                      default=None,
+                      help="Write a Chrome trace-event json file with the duration of each phase and command (load it in Perfetto)")
+
+    # limit on commands run at the same time
+    parser.add_argument("--jobs-uberenv",
+                      dest="uberenv_jobs",
+                      type=int,
+                      default=None,
+                      help="Maximum number of independent commands and phases uberenv runs at the same time (default: number of CPUs, at most 8)")
+
+    # copy the output of all commands to a log file
+    parser.add_argument("--log",
+                      dest="log",
+                      default=None,
+                      help="Append the output of all commands uberenv runs to this file")
+
     # option to tell spack to run tests
     parser.add_argument("--run_tests",
                       action="store_true",
@@ -281,12 +679,79 @@ def parse_args():
                       nargs="+",
                       help="Space delimited string of paths for Spack to search for compilers (if no spack_env_file is found)")
 
+    # Shared cache of found compilers and externals
+    parser.add_argument("--discovery-cache",
+                      dest="discovery_cache",
+                      default=None,
+                      help="Directory used to cache the compilers and externals spack finds (can be shared between prefixes)")
+
     # Spack Environment name
     parser.add_argument("--spack-env-name",
                       dest="spack_env_name",
                       default="spack_env",
                       help="The name of the Spack Environment, which will be created in prefix directory.")
 
+    # Shared cache of concretized environments
+    parser.add_argument("--concretize-cache",
+                      dest="concretize_cache",
+                      default=None,
+                      help="Directory used to cache concretized spack.lock files (can be shared between prefixes)")
+
+    # Size limit of the concretization cache
+    parser.add_argument("--concretize-cache-size",
+                      dest="concretize_cache_size",
+                      default=None,
+                      type=int,
+                      help="Maximum size of the concretization cache in MB (default: 1024)")
+
+    # Spack bootstrap store that can be shared between prefixes
+    parser.add_argument("--spack-bootstrap-root",
+                      dest="spack_bootstrap_root",
+                      default=None,
+                      help="Directory spack bootstraps clingo into (can be shared between prefixes)")
+
+    # Local spack bootstrap mirror
+    parser.add_argument("--spack-bootstrap-mirror",
+                      dest="spack_bootstrap_mirror",
+                      default=None,
+                      help="Spack bootstrap mirror (created with `spack bootstrap mirror`) to bootstrap clingo from, without internet access")
+
+    # Bundle everything needed to build without network access
+    parser.add_argument("--export-bundle",
+                      dest="export_bundle",
+                      default=None,
+                      help="Concretize, then write spack, the package repo, a bootstrap mirror, a source mirror and spack.lock to this archive")
+
+    # Build from a bundle written with --export-bundle
+    parser.add_argument("--import-bundle",
+                      dest="import_bundle",
+                      default=None,
+                      help="Archive written with --export-bundle to take spack, packages, bootstrap and sources from (no network access)")
+
+    # Archive the prepared spack setup for other prefixes / CI runs
+    parser.add_argument("--save-setup-snapshot",
+                      dest="save_setup_snapshot",
+                      default=None,
+                      help="Directory to save a snapshot of the prepared spack setup (named by a hash of its inputs) to")
+
+    # Start from a snapshot saved with --save-setup-snapshot
+    parser.add_argument("--restore-setup-snapshot",
+                      dest="restore_setup_snapshot",
+                      default=None,
+                      help="Directory to restore a matching snapshot of the prepared spack setup from, if there is one")
+
+    # Existing spack checkout that is used, but never written to
+    parser.add_argument("--spack-root",
+                      dest="spack_root",
+                      default=None,
+                      help="Use this (read-only) spack checkout instead of cloning spack into the prefix")
+
+    # Bare git repo that holds the spack objects for all prefixes
+    parser.add_argument("--spack-object-store",
+                      dest="spack_object_store",
+                      default=None,
+                      help="Bare git repo shared between prefixes, the spack checkout is added to it as a worktree")
+
     # Spack Environment file
     parser.add_argument("--spack-env-file",
                       dest="spack_env_file",
@@ -308,6 +773,10 @@ def parse_args():
     if not is_windows() and args["mirror"] is not None:
         if not args["mirror"].startswith(("http","oci")) and not os.path.isabs(args["mirror"]):
             args["mirror"] = pabs(args["mirror"])
+    for opt in ("save_setup_snapshot", "restore_setup_snapshot", "export_bundle", "import_bundle",
+                "discovery_cache"):
+        if args[opt] is not None:
+            args[opt] = pabs(args[opt])
     return args, extra_args
 
 def have_internet(host="llnl.gov", port=80, timeout=3):
@@ -333,6 +802,33 @@ def load_json_file(json_file):
     # reads json file
     return json.load(open(json_file))
 
+def load_state(path):
+    """
+    Reads one of uberenv's .uberenv_*.json state files. Returns None when
+    it is missing or unreadable, callers then treat it as no state.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) else None
+
+def save_state(path, state):
+    """
+    Writes a state file (read with load_state) atomically, readers see
+    either the previous or the new state.
+    """
+    tmp = "{0}.tmp.{1}".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+def remove_state(path):
+    # removes a state file, if there is one
+    if os.path.isfile(path):
+        os.remove(path)
+
 def is_darwin():
     return "darwin" in platform.system().lower()
 
@@ -359,6 +855,866 @@ def find_project_config(args):
     print("ERROR: No Uberenv configuration json file found")
     sys.exit(-1)
 
+def hash_file(hasher, path, name=None):
+    # adds the name (path, unless given) and contents of a file (if it
+    # exists) to a hashlib object
+    hasher.update((path if name is None else name).encode("utf8"))
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            for chunk in iter(partial(f.read, 1 << 20), b""):
+                hasher.update(chunk)
+
+def hash_tree(hasher, path):
+    # adds the relative paths and contents of all files under path to a
+    # hashlib object, ignoring python caches and git metadata
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in ("__pycache__", ".git"))
+        for fname in sorted(files):
+            if fname.endswith((".pyc", ".pyo")):
+                continue
+            fpath = pjoin(root, fname)
+            hash_file(hasher, fpath, name=os.path.relpath(fpath, path))
+
+def find_git_dir(repo_dir):
+    """ Returns the git dir of a checkout, or None. """
+    git_dir = pjoin(repo_dir, ".git")
+    if os.path.isfile(git_dir):
+        # worktrees and submodules use a "gitdir: <path>" file
+        with open(git_dir) as f:
+            content = f.read().strip()
+        if not content.startswith("gitdir:"):
+            return None
+        git_dir = pabs(pjoin(repo_dir, content[len("gitdir:"):].strip()))
+    if not os.path.isdir(git_dir):
+        return None
+    return git_dir
+
+def read_git_head_file(git_dir):
+    try:
+        with open(pjoin(git_dir, "HEAD")) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def read_git_head(repo_dir):
+    """
+    Returns the commit checked out in a git repo by reading its metadata
+    directly (no git process), or None if it can not be determined.
+    """
+    git_dir = find_git_dir(repo_dir)
+    if git_dir is None:
+        return None
+    head = read_git_head_file(git_dir)
+    if head is None or not head.startswith("ref:"):
+        return head
+    return resolve_git_ref(git_dir, head[len("ref:"):].strip())
+
+def read_git_branch(repo_dir):
+    """
+    Returns the branch checked out in a git repo (no git process), or
+    None for a detached HEAD or if it can not be determined.
+    """
+    git_dir = find_git_dir(repo_dir)
+    if git_dir is None:
+        return None
+    head = read_git_head_file(git_dir)
+    if head is None or not head.startswith("ref: refs/heads/"):
+        return None
+    return head[len("ref: refs/heads/"):]
+
+def resolve_git_ref(git_dir, ref):
+    # refs live in the common dir for worktrees
+    common_dir = git_dir
+    if os.path.isfile(pjoin(git_dir, "commondir")):
+        with open(pjoin(git_dir, "commondir")) as f:
+            common_dir = pabs(pjoin(git_dir, f.read().strip()))
+    for base in (git_dir, common_dir):
+        ref_file = pjoin(base, ref)
+        if os.path.isfile(ref_file):
+            with open(ref_file) as f:
+                return f.read().strip()
+    packed_refs = pjoin(common_dir, "packed-refs")
+    if os.path.isfile(packed_refs):
+        with open(packed_refs) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    return None
+
+def package_py_dependencies(content):
+    """
+    Names of the packages a spack package.py depends on, extends or
+    imports, as far as a regex can tell.
+    """
+    names = re.findall(r"(?:depends_on|extends)\(\s*[\"']([A-Za-z0-9_\-]+)", content)
+    names += re.findall(r"packages\.(\w+)\.package import", content)
+    return names
+
+def spec_package_names(spec):
+    """
+    Names of the compilers (%gcc, %c=gcc) and dependencies (^hdf5) a spec
+    string mentions.
+    """
+    return re.findall(r"[%^]\s*(?:[A-Za-z0-9_\-]+=)?([A-Za-z][A-Za-z0-9_\-]*)", spec)
+
+def split_shards(items, count):
+    """
+    Splits items round-robin into at most count non-empty shards.
+    """
+    return [items[i::count] for i in range(min(count, len(items)))]
+
+def host_fingerprint():
+    # what spack looks at to pick the default os and target
+    parts = [platform.system(), platform.machine()]
+    if os.path.isfile("/etc/os-release"):
+        with open("/etc/os-release") as f:
+            parts.append(f.read())
+    if os.path.isfile("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("vendor_id", "model name", "flags", "CPU part")):
+                    parts.append(line.strip())
+                elif not line.strip():
+                    # the first processor is enough
+                    break
+    else:
+        parts.append(platform.processor())
+    return "\n".join(parts)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on path (created if needed) for the duration of
+    the with block, so that several uberenv runs can share a directory.
+    """
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# environment variables that change what compilers and externals spack finds
+DISCOVERY_ENV_VARS = ("PATH", "LD_LIBRARY_PATH", "MODULEPATH", "LOADEDMODULES", "CPATH")
+
+# executables resolved in PATH for the discovery cache key, besides spack_externals
+DISCOVERY_EXECUTABLES = ("cc", "c++", "gcc", "g++", "gfortran", "clang", "clang++", "flang",
+                         "icx", "icpx", "ifx", "nvc", "nvc++", "nvfortran", "xlc", "xlf",
+                         "mpicc", "mpicxx", "mpifort", "cmake", "python3", "perl")
+
+def executables_fingerprint(names, dirs):
+    """
+    The search dirs, and the path, inode and mtime each name resolves to in
+    them, so that installing, removing or replacing a compiler or tool
+    spack could detect changes it.
+    """
+    search_path = os.pathsep.join(dirs)
+    parts = ["dirs: {0}".format(search_path)]
+    for name in sorted(set(names)):
+        exe = shutil.which(name, path=search_path)
+        if exe is None:
+            parts.append("{0}: -".format(name))
+            continue
+        try:
+            st = os.stat(exe)
+        except OSError:
+            parts.append("{0}: {1} -".format(name, exe))
+            continue
+        parts.append("{0}: {1} {2} {3}".format(name, exe, st.st_ino, st.st_mtime_ns))
+    return "\n".join(parts)
+
+
+class ConcretizationCache():
+    """
+    Content-addressed store of concretized spack.lock files.
+
+    Entries are named by a hash of everything the concretizer reads, so the
+    cache directory can be shared by any number of prefixes. When the cache
+    grows past max_size bytes the least recently used entries are removed.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = pabs(path)
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def entry_path(self, key):
+        return pjoin(self.path, "{0}.lock".format(key))
+
+    def restore(self, key, dest):
+        """
+        Copies the cached lock file for key to dest, returns True on a hit.
+        """
+        src = self.entry_path(key)
+        if not os.path.isfile(src):
+            return False
+        tmp = "{0}.tmp.{1}".format(dest, os.getpid())
+        try:
+            shutil.copyfile(src, tmp)
+        except IOError:
+            # evicted by another uberenv in the meantime
+            return False
+        os.replace(tmp, dest)
+        # mark as recently used
+        os.utime(src, None)
+        return True
+
+    def store(self, key, src):
+        tmp = "{0}.tmp.{1}".format(self.entry_path(key), os.getpid())
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, self.entry_path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for fname in glob.glob(pjoin(self.path, "*.lock")):
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in sorted(entries):
+            if total <= self.max_size:
+                break
+            print("[evicting concretization cache entry {0}]".format(fname))
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            total -= size
+
+
+# Worker run via `spack python -c` for SpackSession.
+#
+# Spack is imported once, then every request is run in a forked child
+# via spack.main.main(argv), so each command gets a fresh copy of the warm
+# interpreter and none of its global state leaks into the next command.
+# Requests and replies are json lines, replies are tagged with the request
+# id so several commands can be in flight at once.
+SPACK_SESSION_WORKER = r'''
+import codecs, json, os, select, sys, traceback
+import spack.main
+
+proto = os.fdopen(os.dup(1), "w")
+# anything else written to stdout by the worker goes to stderr
+os.dup2(2, 1)
+
+def send(msg):
+    proto.write(json.dumps(msg) + "\n")
+    proto.flush()
+
+def reset_spack_state():
+    # drop lazily created singletons so children re-read config and repos
+    for modname, attr in (("spack.config", "CONFIG"),
+                          ("spack.repo", "PATH"),
+                          ("spack.store", "STORE")):
+        obj = getattr(sys.modules.get(modname), attr, None)
+        if obj is not None and hasattr(obj, "_instance"):
+            obj._instance = None
+
+def start(req):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        rc = 1
+        try:
+            os.close(r)
+            os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+            os.dup2(w, 1)
+            os.dup2(w, 2)
+            os.environ.clear()
+            os.environ.update(req["env"])
+            os.chdir(req["cwd"])
+            reset_spack_state()
+            try:
+                rc = spack.main.main(req["argv"])
+            except SystemExit as e:
+                rc = e.code
+            if rc is None:
+                rc = 0
+            elif not isinstance(rc, int):
+                rc = 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(rc)
+    os.close(w)
+    children[r] = (req["id"], pid, codecs.getincrementaldecoder("utf8")("replace"))
+
+def finish(fd):
+    req_id, pid, decoder = children.pop(fd)
+    os.close(fd)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        send({"id": req_id, "out": tail})
+    _, status, ru = os.wait4(pid, 0)
+    if os.WIFEXITED(status):
+        rc = os.WEXITSTATUS(status)
+    else:
+        rc = -os.WTERMSIG(status)
+    maxrss = ru.ru_maxrss // 1024 if sys.platform == "darwin" else ru.ru_maxrss
+    send({"id": req_id, "rc": rc,
+          "rusage": {"utime": ru.ru_utime, "stime": ru.ru_stime, "maxrss": maxrss,
+                     "inblock": ru.ru_inblock, "oublock": ru.ru_oublock,
+                     "nvcsw": ru.ru_nvcsw, "nivcsw": ru.ru_nivcsw}})
+
+children = {}
+stdin_fd = sys.stdin.fileno()
+pending = b""
+stdin_open = True
+send({"ready": True})
+while stdin_open or children:
+    fds = list(children.keys()) + ([stdin_fd] if stdin_open else [])
+    ready, _, _ = select.select(fds, [], [])
+    for fd in ready:
+        if fd == stdin_fd:
+            data = os.read(stdin_fd, 65536)
+            if not data:
+                stdin_open = False
+                continue
+            pending += data
+            while b"\n" in pending:
+                line, pending = pending.split(b"\n", 1)
+                if line.strip():
+                    start(json.loads(line.decode("utf8")))
+        else:
+            data = os.read(fd, 65536)
+            if not data:
+                finish(fd)
+                continue
+            out = children[fd][2].decode(data)
+            if out:
+                send({"id": children[fd][0], "out": out})
+'''
+
+
+# Script run via `spack python -c` to edit an environment's spack.yaml.
+#
+# Applies all of uberenv's changes (repos, specs, develop, mirrors and
+# upstreams) in one atomic write, using Spack's own yaml support so
+# comments and ordering of the user's file are kept, then loads the
+# environment once to validate it. The original file is restored if the
+# result does not validate. "request" is filled in by uberenv.
+SPACK_MANIFEST_EDITOR = r'''
+import json, os, sys
+import spack.environment as ev
+import spack.util.spack_yaml as syaml
+
+def norm(path):
+    return os.path.normpath(os.path.abspath(os.path.expandvars(os.path.expanduser(str(path)))))
+
+def repo_namespace(path):
+    with open(os.path.join(path, "repo.yaml")) as f:
+        return syaml.load(f)["repo"]["namespace"]
+
+def edit_repos(root, remove, add):
+    remove = set(norm(p) for p in remove + add)
+    repos = root.get("repos")
+    if isinstance(repos, dict):
+        # newer spack: named repos, earlier entries have higher priority
+        new_repos = syaml.syaml_dict()
+        for path in reversed(add):
+            new_repos[repo_namespace(path)] = path
+        for name, path in repos.items():
+            if name not in new_repos and norm(path) not in remove:
+                new_repos[name] = path
+    else:
+        # same order `spack repo add` would give: last added comes first
+        new_repos = list(reversed(add))
+        new_repos += [p for p in (repos or []) if norm(p) not in remove]
+    if new_repos:
+        root["repos"] = new_repos
+    elif "repos" in root:
+        del root["repos"]
+
+def edit_named(root, section, remove, add):
+    entries = root.get(section) or syaml.syaml_dict()
+    if remove is not None:
+        entries.pop(remove[0], None)
+    if add is not None:
+        entries[add[0]] = add[1]
+    if entries:
+        root[section] = entries
+    elif section in root:
+        del root[section]
+
+def main(req):
+    manifest = os.path.join(req["env_dir"], "spack.yaml")
+    with open(manifest) as f:
+        original = f.read()
+    data = syaml.load_config(original) or syaml.syaml_dict()
+    root = data.setdefault("spack", syaml.syaml_dict())
+    orig_repos = str(root.get("repos", ""))
+
+    edit_repos(root, req["remove_repos"], req["add_repos"])
+
+    specs = [s for s in (root.get("specs") or []) if s != req["remove_spec"]]
+    if req["add_spec"] is not None and req["add_spec"] not in specs:
+        specs.append(req["add_spec"])
+    root["specs"] = specs
+
+    develop = root.get("develop") or syaml.syaml_dict()
+    if req["remove_develop"] is not None:
+        develop.pop(req["remove_develop"], None)
+    if req["add_develop"] is not None:
+        develop[req["add_develop"][0]] = {"spec": req["add_develop"][1],
+                                          "path": req["add_develop"][2]}
+    if develop:
+        root["develop"] = develop
+    elif "develop" in root:
+        del root["develop"]
+
+    edit_named(root, "mirrors", req["remove_mirror"], req["add_mirror"])
+    upstream = req["add_upstream"]
+    if upstream is not None:
+        upstream = [upstream[0], {"install_tree": upstream[1]}]
+    edit_named(root, "upstreams", req["remove_upstream"], upstream)
+
+    tmp = manifest + ".uberenv.tmp"
+    with open(tmp, "w") as f:
+        syaml.dump_config(data, f, default_flow_style=False)
+    os.replace(tmp, manifest)
+
+    # validate by loading the environment
+    try:
+        ev.Environment(req["env_dir"])
+    except Exception as e:
+        with open(tmp, "w") as f:
+            f.write(original)
+        os.replace(tmp, manifest)
+        print("[ERROR: Updated Spack Environment is not valid: {0}]".format(e))
+        sys.exit(1)
+    print("[uberenv manifest: " + json.dumps({"builtin_repo": "builtin" in orig_repos}) + "]")
+
+main(request)
+'''
+
+
+# Script run via `spack python -c` to merge the packages found by sharded
+# `spack external find` runs (see find_externals) into an environment.
+#
+# Each shard ran in a scratch copy of the environment, so only entries
+# that differ from the environment's own are taken. New packages are
+# added in name order and externals found by several shards are added
+# once, so the result does not depend on which shard finished first.
+# "request" is filled in by uberenv.
+SPACK_EXTERNALS_MERGER = r'''
+import json, os
+import spack.util.spack_yaml as syaml
+
+def load_manifest(path):
+    with open(path) as f:
+        return syaml.load_config(f.read()) or syaml.syaml_dict()
+
+def main(req):
+    manifest = os.path.join(req["env_dir"], "spack.yaml")
+    data = load_manifest(manifest)
+    root = data.setdefault("spack", syaml.syaml_dict())
+    packages = root.get("packages") or syaml.syaml_dict()
+
+    found = {}
+    for shard_dir in req["shards"]:
+        shard_root = load_manifest(os.path.join(shard_dir, "spack.yaml")).get("spack") or {}
+        for name, entry in (shard_root.get("packages") or {}).items():
+            if packages.get(name) != entry:
+                found.setdefault(name, []).append(entry)
+
+    for name in sorted(found):
+        merged = syaml.syaml_dict(packages.get(name) or {})
+        externals = list(merged.get("externals") or [])
+        specs = set(str(e.get("spec")) for e in externals)
+        for entry in found[name]:
+            for key, value in entry.items():
+                if key != "externals":
+                    merged[key] = value
+            for external in entry.get("externals") or []:
+                if str(external.get("spec")) not in specs:
+                    specs.add(str(external.get("spec")))
+                    externals.append(external)
+        if externals:
+            merged["externals"] = externals
+        packages[name] = merged
+    if packages:
+        root["packages"] = packages
+
+    tmp = manifest + ".uberenv.tmp"
+    with open(tmp, "w") as f:
+        syaml.dump_config(data, f, default_flow_style=False)
+    os.replace(tmp, manifest)
+    print("[uberenv externals: " + json.dumps(sorted(found)) + "]")
+
+main(request)
+'''
+
+
+# Script run via `spack python -c` to learn, in one spack startup, the
+# facts uberenv needs about a spack checkout: the python spack runs
+# under, spack's version and which concretizer options `spack install`
+# supports.
+SPACK_CONFIG_SCOPES = r'''
+import json
+import spack.config
+
+# older spack names the global configuration spack.config.config
+config = spack.config.CONFIG if hasattr(spack.config, "CONFIG") else spack.config.config
+paths = []
+for scope in config.scopes.values():
+    # internal scopes (command line, overrides) have no path
+    path = getattr(scope, "path", None)
+    if path:
+        paths.append(path)
+print("[uberenv config scopes: " + json.dumps(paths) + "]")
+'''
+
+SPACK_PROBE = r'''
+import contextlib, io, json, sys
+import spack
+import spack.main
+
+help_out = io.StringIO()
+with contextlib.redirect_stdout(help_out):
+    try:
+        spack.main.main(["help", "install"])
+    except SystemExit:
+        pass
+if hasattr(spack.main, "get_version"):
+    version = spack.main.get_version()
+else:
+    version = str(spack.spack_version)
+print("[uberenv probe: " + json.dumps({"python": sys.executable,
+                                        "version": version,
+                                        "fresh": "--fresh" in help_out.getvalue(),
+                                        "reuse": "--reuse" in help_out.getvalue()}) + "]")
+'''
+
+
+class SpackSession():
+    """
+    Runs spack commands through one long-lived `spack python` worker,
+    so Spack's startup cost is only paid once per uberenv run.
+    """
+
+    def __init__(self, spack_path):
+        self.spack_path = spack_path
+        self.proc = None
+        self.reader = None
+        self.replies = {}
+        self.next_id = 0
+        self.alive = False
+        self.lock = threading.Lock()
+        self.spack_vars = None
+
+    def start(self):
+        """
+        Starts the worker, returns False if it could not be started.
+        """
+        print("[starting spack session: {0} python]".format(self.spack_path))
+        try:
+            self.proc = subprocess.Popen([self.spack_path, "python", "-c", SPACK_SESSION_WORKER],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        except OSError as e:
+            print("[WARNING: Failed to start spack session: {0}]".format(e))
+            self.proc = None
+            return False
+        line = self.proc.stdout.readline()
+        try:
+            ready = json.loads(line.decode("utf8")).get("ready", False)
+        except ValueError:
+            ready = False
+        if not ready:
+            print("[WARNING: Spack session worker did not start, falling back to one spack process per command]")
+            self.close()
+            return False
+        # spack reads some SPACK_* variables at import time, the session is
+        # only valid while they keep the values the worker started with
+        self.spack_vars = self.current_spack_vars()
+        self.alive = True
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+        return True
+
+    @staticmethod
+    def current_spack_vars():
+        return dict((k, v) for k, v in os.environ.items() if k.startswith("SPACK_"))
+
+    def is_valid(self):
+        return self.alive and \
+               self.proc.poll() is None and \
+               self.spack_vars == self.current_spack_vars()
+
+    def read_replies(self):
+        for line in self.proc.stdout:
+            msg = json.loads(line.decode("utf8"))
+            with self.lock:
+                reply_queue = self.replies.get(msg["id"])
+            if reply_queue is not None:
+                reply_queue.put(msg)
+        # worker is gone, wake up anyone still waiting
+        with self.lock:
+            self.alive = False
+            for reply_queue in self.replies.values():
+                reply_queue.put({"rc": -1})
+
+    def run(self, argv, ret_output=False, parsers=(), env=None):
+        """
+        Runs spack with the given arguments (without the spack executable).
+        Mirrors sexe: returns (returncode, output) when ret_output is True,
+        otherwise streams the output and returns the returncode. env holds
+        variables set on top of os.environ for this command.
+        """
+        cmd_env = dict(os.environ)
+        cmd_env.update(env or {})
+        reply_queue = queue.Queue()
+        with self.lock:
+            req_id = self.next_id
+            self.next_id += 1
+            self.replies[req_id] = reply_queue
+            req = {"id": req_id,
+                   "argv": argv,
+                   "env": cmd_env,
+                   "cwd": os.getcwd()}
+            try:
+                if not self.alive:
+                    raise OSError("spack session worker exited")
+                self.proc.stdin.write((json.dumps(req) + "\n").encode("utf8"))
+                self.proc.stdin.flush()
+            except (OSError, ValueError):
+                reply_queue.put({"rc": -1})
+        stream = OutputStream(quiet=ret_output, parsers=parsers)
+        with tracer.span(command_span_name(["spack"] + argv), "command",
+                         cmd=join_argv(["spack"] + argv), session=True) as span:
+            while True:
+                msg = reply_queue.get()
+                if "out" in msg:
+                    stream.write(msg["out"])
+                if "rc" in msg:
+                    break
+            span["rc"] = msg["rc"]
+            if "rusage" in msg:
+                span.update(msg["rusage"])
+                resource_usage.add(msg["rusage"])
+        stream.close()
+        with self.lock:
+            del self.replies[req_id]
+        if ret_output:
+            return msg["rc"], stream.output()
+        return msg["rc"]
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except (OSError, ValueError):
+            pass
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+
+class Phase():
+    """
+    One step of an uberenv run.
+
+    inputs names the outputs of other phases this phase depends on, outputs
+    lists what it provides besides its own name. Completed checkpoint phases
+    are recorded, and can be skipped when resuming a failed run. key returns
+    a hash of the settings the phase depends on (default: all settings),
+    exists whether what the phase made is still there (a recorded phase
+    is run again when it is not). A phase that returns INCOMPLETE (e.g.
+    it skipped its work) is not recorded.
+    """
+
+    INCOMPLETE = "incomplete"
+
+    def __init__(self, name, func, inputs=(), outputs=(), checkpoint=False, key=None, exists=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = (name,) + tuple(outputs)
+        self.checkpoint = checkpoint
+        self.key = key
+        self.exists = exists
+
+    def is_recorded(self, state, inputs_hash):
+        # completed with the same inputs, and its results are still there
+        return state.is_complete(self.name, inputs_hash) and \
+               (self.exists is None or self.exists())
+
+
+class PhaseState():
+    """
+    Json file recording which checkpoint phases completed, and the hash of
+    the inputs they completed with.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = (load_state(path) or {}).get("completed", {})
+
+    def is_complete(self, name, inputs_hash):
+        with self.lock:
+            return self.completed.get(name) == inputs_hash
+
+    def invalidate(self, names):
+        with self.lock:
+            for name in names:
+                self.completed.pop(name, None)
+            self.write()
+
+    def complete(self, name, inputs_hash):
+        with self.lock:
+            self.completed[name] = inputs_hash
+            self.write()
+
+    def write(self):
+        save_state(self.path, {"completed": self.completed})
+
+
+class PhaseGraph():
+    """
+    Runs phases on a thread pool, starting each phase as soon as every
+    phase it depends on has finished.
+
+    With a PhaseState, completed checkpoint phases are recorded under a
+    hash of their key (or inputs_hash) and the hashes of the phases they
+    depend on. When resuming, phases recorded with an unchanged hash are
+    skipped.
+    """
+
+    def __init__(self, phases, max_workers=None, state=None, inputs_hash="", resume=False):
+        self.phases = dict((phase.name, phase) for phase in phases)
+        self.results = {}
+
+        # map every output to the phase producing it
+        producers = {}
+        for phase in phases:
+            for output in phase.outputs:
+                if output in producers:
+                    print("[ERROR: '{0}' is provided by phases '{1}' and '{2}']".format(
+                          output, producers[output], phase.name))
+                    sys.exit(-1)
+                producers[output] = phase.name
+
+        self.deps = {}
+        for phase in phases:
+            for phase_input in phase.inputs:
+                if phase_input not in producers:
+                    print("[ERROR: Phase '{0}' needs '{1}', which no phase provides]".format(
+                          phase.name, phase_input))
+                    sys.exit(-1)
+            self.deps[phase.name] = set(producers[i] for i in phase.inputs)
+        self.max_workers = max_workers
+        self.state = state
+        self.inputs_hash = inputs_hash
+        self.resume = resume
+        self.hashes = {}
+
+    def phase_hash(self, name, visiting=()):
+        if name not in self.hashes:
+            if name in visiting:
+                print("[ERROR: Cycle between phases: {0}]".format(", ".join(visiting)))
+                sys.exit(-1)
+            phase = self.phases[name]
+            h = hashlib.sha256()
+            h.update((phase.key() if phase.key else self.inputs_hash).encode("utf8"))
+            h.update(name.encode("utf8"))
+            for dep in sorted(self.deps[name]):
+                h.update(self.phase_hash(dep, visiting + (name,)).encode("utf8"))
+            self.hashes[name] = h.hexdigest()
+        return self.hashes[name]
+
+    def dependents(self, name):
+        # all phases that (indirectly) depend on name
+        res = set()
+        todo = [name]
+        while todo:
+            current = todo.pop()
+            for other, deps in self.deps.items():
+                if current in deps and other not in res:
+                    res.add(other)
+                    todo.append(other)
+        return res
+
+    def run_phase(self, phase):
+        if self.state is not None and phase.checkpoint:
+            # whatever was recorded for this phase and the phases after it
+            # no longer holds once it runs again
+            self.state.invalidate([phase.name] + sorted(self.dependents(phase.name)))
+        previous = current_phase.name
+        current_phase.name = phase.name
+        try:
+            with tracer.span(phase.name, "phase") as span:
+                res = phase.func()
+                if isinstance(res, int):
+                    span["rc"] = res
+        finally:
+            current_phase.name = previous
+        if self.state is not None and phase.checkpoint and res in (None, 0):
+            self.state.complete(phase.name, self.phase_hash(phase.name))
+        return res
+
+    def run(self):
+        """
+        Runs all phases, returns a dict of their return values.
+        Errors raised by a phase (including sys.exit) are re-raised here
+        once the phases already running have finished.
+        """
+        done = set()
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while len(done) < len(self.phases):
+                # skipped phases can make more phases ready right away
+                progress = True
+                while progress:
+                    progress = False
+                    for name, phase in self.phases.items():
+                        if name not in done and \
+                           name not in running.values() and \
+                           self.deps[name] <= done:
+                            if self.resume and phase.checkpoint and \
+                               phase.is_recorded(self.state, self.phase_hash(name)):
+                                print("[resume: skipping completed phase '{0}']".format(name))
+                                with tracer.span(name, "phase", skipped=True):
+                                    pass
+                                self.results[name] = None
+                                done.add(name)
+                                progress = True
+                            else:
+                                running[pool.submit(self.run_phase, phase)] = name
+                if not running:
+                    if len(done) == len(self.phases):
+                        break
+                    print("[ERROR: Cycle between phases: {0}]".format(
+                          ", ".join(sorted(set(self.phases) - done))))
+                    sys.exit(-1)
+                finished, _ = concurrent.futures.wait(running,
+                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    # re-raises failures from the phase
+                    self.results[name] = future.result()
+                    done.add(name)
+        return self.results
+
 
 class UberEnv():
     """ Base class for package manager """
@@ -368,7 +1724,8 @@ class UberEnv():
         self.extra_args = extra_args
 
         # load project settings
-        self.project_args = load_json_file(args["project_json"])
+        self.project_json = pabs(args["project_json"])
+        self.project_args = load_json_file(self.project_json)
 
         # setup main package name
         self.pkg_name = self.set_from_args_or_json("package_name")
@@ -385,6 +1742,46 @@ class UberEnv():
         pretty_print_dictionary(self.args)
         print("]")
 
+    def uberenv_jobs(self):
+        """
+        Number of commands and phases uberenv runs at the same time:
+        --jobs-uberenv, or the number of CPUs up to 8.
+        """
+        if self.args["uberenv_jobs"] is not None:
+            return max(1, self.args["uberenv_jobs"])
+        return min(8, os.cpu_count() or 1)
+
+    def run_commands(self, commands, done=None):
+        """
+        Runs independent commands concurrently on a thread pool, at most
+        uberenv_jobs() at a time, and returns their results in order.
+
+        Each command is a dict of sexe_argv keyword arguments (argv,
+        ret_output, echo, env, parsers). The commands are accounted to
+        the phase calling run_commands. If given, done(index, result) is
+        called from the calling thread as each command completes.
+        """
+        phase = current_phase.name
+        def run_one(command):
+            current_phase.name = phase
+            return self.run_one_command(**command)
+        results = [None] * len(commands)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.uberenv_jobs()) as pool:
+            futures = {pool.submit(run_one, command): i for i, command in enumerate(commands)}
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                if done is not None:
+                    done(i, results[i])
+        return results
+
+    def run_one_command(self, **command):
+        """
+        Runs one command of run_commands, subclasses can route commands
+        elsewhere.
+        """
+        return sexe_argv(**command)
+
     def setup_paths_and_dirs(self):
         self.uberenv_path = uberenv_script_dir()
 
@@ -439,6 +1836,30 @@ class UberEnv():
                 raise
         return setting_value
 
+    def install_is_current(self):
+        """
+        Returns True if a previous run already installed exactly what was
+        asked for, so there is nothing left to do.
+        """
+        return False
+
+    def phase_inputs_hash(self):
+        """
+        Hash of the settings checkpoint phases are recorded with, resuming
+        only skips phases recorded with the same hash.
+        """
+        return ""
+
+    def setup_phases(self):
+        """
+        Phases that fetch and prepare the package manager, used by main()
+        unless setup is skipped. Subclasses can split these up further so
+        independent steps run concurrently.
+        """
+        return [Phase("clone_repo", self.clone_repo),
+                Phase("patch", self.patch, inputs=["clone_repo"]),
+                Phase("clean_build", self.clean_build, inputs=["patch"], outputs=["setup"])]
+
     def detect_platform(self):
         # find supported spack.yaml
         if is_darwin():
@@ -553,10 +1974,18 @@ class VcpkgEnv(UberEnv):
     def show_info(self):
         os.chdir(self.dest_vcpkg)
         print("[info: Details for package '{0}']".format(self.pkg_name))
-        sexe("vcpkg.exe search " + self.pkg_name, echo=True)
+        # both queries run at once, the search streams its output and the
+        # dependencies are printed after it
+        depend_argv = ["vcpkg.exe", "depend-info", self.pkg_name]
+        write_log("[exe: {0}]\n".format(join_argv(depend_argv)))
+        results = self.run_commands([
+            {"argv": ["vcpkg.exe", "search", self.pkg_name], "echo": True},
+            {"argv": depend_argv, "ret_output": True}])
+        res_depend, out_depend = results[1]
 
         print("[info: Dependencies for package '{0}']".format(self.pkg_name))
-        sexe("vcpkg.exe depend-info " + self.pkg_name, echo=True)
+        print("[exe: {0}]".format(join_argv(depend_argv)))
+        print(out_depend, end="")
 
     def create_mirror(self):
         pass
@@ -650,9 +2079,35 @@ class SpackEnv(UberEnv):
         self.fresh_exists = False
         self.reuse_exists = False
 
-    # Spack executable (will include environment -e option by default)
-    def spack_exe(self, use_spack_env = True):
-        exe = pjoin(self.dest_dir, "spack/bin/spack")
+        # Persistent spack python worker (see --spack-session), phases
+        # running at the same time share it
+        self.spack_session = None
+        self.spack_session_lock = threading.RLock()
+
+        # Config scope our settings are written to ("user" with spack_root)
+        self.spack_config_scope = "defaults"
+
+        # Filled in by the setup phases
+        self.builtin_repo_current = False
+        self.sparse_packages = None
+        self.sparse_providers = None
+        self.spack_python = None
+        self.spack_version_str = None
+        self.internet_available = None
+
+        # Set when a new environment still has to be checked for its own
+        # builtin package repository
+        self.check_env_builtin_repo = False
+
+        # Results of install, recorded in the install manifest
+        self.host_config_path = None
+        self.install_prefix = None
+        # install paths of the dependencies a dev-build host-config uses
+        self.tpl_prefixes = []
+
+    # Spack executable (will include environment -e option by default)
+    def spack_exe(self, use_spack_env = True):
+        exe = pjoin(self.dest_spack, "bin", "spack")
 
         # Add debug flags
         if self.args["spack_debug"]:
@@ -664,21 +2119,90 @@ class SpackEnv(UberEnv):
 
         return exe
 
+    # Runs a spack command, through the spack session if one is enabled
+    def spack_sexe(self, spack_args, use_spack_env=True, ret_output=False, echo=False, parsers=()):
+        cmd = "{0} {1}".format(self.spack_exe(use_spack_env), spack_args)
+        session = self.get_spack_session()
+        if session is None:
+            return sexe(cmd, ret_output=ret_output, echo=echo, parsers=parsers)
+        if echo:
+            print("[exe: {0}]".format(cmd))
+            write_log("[exe: {0}]\n".format(cmd))
+        # the session runs spack in-process, so drop the executable
+        return session.run(shlex.split(cmd)[1:], ret_output=ret_output, parsers=parsers)
+
+    def spack_command(self, spack_args, use_spack_env=True, ret_output=False, echo=False, parsers=()):
+        """
+        Returns spack_args as a command for run_commands.
+        """
+        cmd = "{0} {1}".format(self.spack_exe(use_spack_env), spack_args)
+        return {"argv": shlex.split(cmd),
+                "ret_output": ret_output,
+                "echo": echo,
+                "parsers": parsers}
+
+    def run_one_command(self, **command):
+        # spack commands go through the session when there is one, unless
+        # they change SPACK_* variables spack reads at import time
+        session = self.get_spack_session()
+        overlay = command.get("env") or {}
+        if session is None or \
+           command["argv"][0] != pjoin(self.dest_spack, "bin", "spack") or \
+           any(k.startswith("SPACK_") for k in overlay):
+            return sexe_argv(**command)
+        if command.get("echo"):
+            print("[exe: {0}]".format(join_argv(command["argv"])))
+            write_log("[exe: {0}]\n".format(join_argv(command["argv"])))
+        return session.run(command["argv"][1:],
+                           ret_output=command.get("ret_output", False),
+                           parsers=command.get("parsers", ()),
+                           env=command.get("env"))
+
+    def get_spack_session(self):
+        with self.spack_session_lock:
+            if not self.args["spack_session"]:
+                return None
+            if self.spack_session is not None and not self.spack_session.is_valid():
+                self.stop_spack_session()
+            if self.spack_session is None:
+                spack_path = pjoin(self.dest_spack, "bin", "spack")
+                if not os.path.isfile(spack_path):
+                    return None
+                session = SpackSession(spack_path)
+                if not session.start():
+                    # do not retry for every command
+                    self.args["spack_session"] = False
+                    return None
+                atexit.register(session.close)
+                self.spack_session = session
+            return self.spack_session
+
+    def stop_spack_session(self):
+        # must be called whenever the spack checkout changes, the worker
+        # has already imported the old sources
+        with self.spack_session_lock:
+            if self.spack_session is not None:
+                self.spack_session.close()
+                self.spack_session = None
+
     # Returns version of Spack being used
     def spack_version(self):
-        res, out = sexe('{0} --version'.format(self.spack_exe(use_spack_env=False)), ret_output=True)
-        return out
-
-    def check_concretizer_args(self):
-        cmd = "{0} help install".format(self.spack_exe(use_spack_env=False))
-        print("[Checking for concretizer options...]")
-        res, out = sexe( cmd, ret_output = True)
-        if "--fresh" in out:
-            self.fresh_exists = True
-            print("[--fresh exists.]")
-        if "--reuse" in out:
-            self.reuse_exists = True
-            print("[--reuse exists.]")
+        if self.spack_version_str is None:
+            res, out = self.spack_sexe("--version", use_spack_env=False, ret_output=True)
+            self.spack_version_str = out
+        return self.spack_version_str
+
+    # Returns if we can reach the internet (only checked once)
+    def check_internet(self):
+        if self.internet_available is None:
+            self.internet_available = have_internet()
+        return self.internet_available
+
+    # Checks for internet unless clingo is already bootstrapped
+    def check_internet_for_bootstrap(self):
+        if self.bootstrap_is_complete():
+            return
+        self.check_internet()
 
     def add_concretizer_args(self, options):
         # reuse is now default in spack, if on and exists use that
@@ -689,10 +2213,223 @@ class SpackEnv(UberEnv):
             options += "--fresh "
         return options
 
-    def print_spack_python_info(self):
-        cmd = "{0} python -c \"import sys; print(sys.executable);\"".format(self.spack_exe(use_spack_env=False))
-        res, out = sexe( cmd, ret_output = True)
-        print("[spack python: {0}]".format(out.strip()))
+    def probe_spack(self):
+        """
+        Finds spack's python, version and concretizer options with a single
+        spack python call. The results only depend on the spack commit (and
+        SPACK_PYTHON), and are kept in the prefix for later runs.
+        """
+        commit = read_git_head(self.dest_spack)
+        probe_file = pjoin(self.dest_dir, ".uberenv_spack_probe.json")
+        probe = None
+        if commit is not None:
+            cached = load_state(probe_file) or {}
+            if cached.get("commit") == commit and \
+               cached.get("spack_python_var") == os.environ.get("SPACK_PYTHON") and \
+               os.path.exists(cached.get("python", "")):
+                print("[using spack capabilities probed for spack commit {0}]".format(commit))
+                probe = cached
+
+        if probe is None:
+            res, out = self.spack_sexe("python -c {0}".format(shlex.quote(SPACK_PROBE)),
+                                       use_spack_env=False, ret_output=True)
+            for line in out.splitlines():
+                if line.startswith("[uberenv probe: "):
+                    probe = json.loads(line[len("[uberenv probe: "):-1])
+            if res != 0 or probe is None:
+                print("[WARNING: Failed to probe spack in one call, probing with separate commands]")
+                probe = self.probe_spack_commands()
+            elif commit is not None:
+                probe["commit"] = commit
+                probe["spack_python_var"] = os.environ.get("SPACK_PYTHON")
+                save_state(probe_file, probe)
+
+        print("[spack python: {0}]".format(probe["python"]))
+        self.spack_python = probe["python"]
+        self.spack_version_str = probe["version"]
+        print("[Checking for concretizer options...]")
+        if probe["fresh"]:
+            self.fresh_exists = True
+            print("[--fresh exists.]")
+        if probe["reuse"]:
+            self.reuse_exists = True
+            print("[--reuse exists.]")
+
+    def probe_spack_commands(self):
+        """
+        Finds spack's python, version and concretizer options with separate
+        spack commands, run at the same time, for spack versions the single
+        probe call fails on.
+        """
+        (res_python, out_python), (res_version, out_version), (res_help, out_help) = self.run_commands([
+            self.spack_command("python -c \"import sys; print(sys.executable);\"",
+                               use_spack_env=False, ret_output=True),
+            self.spack_command("--version", use_spack_env=False, ret_output=True),
+            self.spack_command("help install", use_spack_env=False, ret_output=True)])
+        python = None
+        if res_python == 0 and out_python.strip():
+            python = out_python.strip().splitlines()[-1]
+        return {"python": python,
+                "version": out_version,
+                "fresh": "--fresh" in out_help,
+                "reuse": "--reuse" in out_help}
+
+    def compile_spack(self):
+        """
+        Compiles spack's python sources to bytecode, using all cores, with
+        the interpreter spack runs under. Spack commands then start warm,
+        instead of each compiling (and racing to write) the same files.
+        """
+        if self.spack_python is None:
+            print("[WARNING: Spack python is unknown, not precompiling spack]")
+            return
+        if self.spack_root is not None:
+            print("[info: not precompiling read-only spack checkout {0}]".format(self.spack_root))
+            return
+        lib_spack = pjoin(self.dest_spack, "lib", "spack")
+        print("[precompiling {0}]".format(lib_spack))
+        res, out = sexe_argv([self.spack_python, "-m", "compileall", "-q", "-j", "0", lib_spack],
+                             ret_output=True)
+        if res != 0:
+            # e.g. test data that is not meant to compile, spack still works
+            print("[WARNING: Some of spack's python files could not be precompiled]")
+
+    # Files in the prefix that record the setup, saved with a setup snapshot
+    setup_snapshot_files = (".uberenv_spack_probe.json",
+                            ".uberenv_builtin_repo.json",
+                            ".uberenv_bootstrap.json",
+                            ".uberenv_clean_build.json")
+
+    def setup_snapshot_path(self, snapshot_dir):
+        """
+        The setup snapshot archive in snapshot_dir for the current setup
+        inputs: the spack pins, bootstrap settings, spack python and host.
+        """
+        h = hashlib.sha256()
+        h.update(self.setup_inputs_hash().encode("utf8"))
+        h.update(host_fingerprint().encode("utf8"))
+        h.update(str([self.spack_bootstrap_root,
+                      self.spack_bootstrap_mirror,
+                      self.args["spack_packages_sparse"],
+                      os.environ.get("SPACK_PYTHON")]).encode("utf8"))
+        return pjoin(snapshot_dir, "uberenv-setup-{0}.tar.gz".format(h.hexdigest()))
+
+    def setup_snapshot_members(self):
+        """
+        The directories and files, relative to the prefix, that make up the
+        prepared spack setup.
+        """
+        members = [os.path.relpath(self.spack_config_scope_path(), self.dest_dir)
+                   if self.spack_root is not None else "spack"]
+        packages_repo = self.builtin_packages_repo_path()
+        if packages_repo.startswith(self.dest_dir + os.sep) and os.path.isdir(packages_repo):
+            members.append(os.path.relpath(packages_repo, self.dest_dir))
+        members += [f for f in self.setup_snapshot_files if os.path.isfile(pjoin(self.dest_dir, f))]
+        return members
+
+    def save_setup_snapshot(self):
+        """
+        Archives the prepared spack checkout, builtin packages repo,
+        bootstrap store and the setup records of the prefix, unless the
+        snapshot for these inputs already exists.
+        """
+        snapshot = self.setup_snapshot_path(self.args["save_setup_snapshot"])
+        if os.path.isfile(snapshot):
+            print("[info: setup snapshot {0} already exists]".format(snapshot))
+            return
+        if self.spack_object_store is not None:
+            print("[WARNING: Not saving a setup snapshot, the spack checkout is a worktree of {0}]".format(
+                  self.spack_object_store))
+            return
+
+        def exclude_installs(tarinfo):
+            # installs and downloads are not part of the setup
+            if tarinfo.name in ("spack/opt/spack", "spack/var/spack/cache",
+                                "spack/var/spack/environments"):
+                return None
+            return tarinfo
+
+        if not os.path.isdir(os.path.dirname(snapshot)):
+            os.makedirs(os.path.dirname(snapshot))
+        print("[saving setup snapshot {0}]".format(snapshot))
+        bootstrap_root = os.path.dirname(self.bootstrap_store_path())
+        tmp = "{0}.tmp.{1}".format(snapshot, os.getpid())
+        with tarfile.open(tmp, "w:gz", compresslevel=6) as tar:
+            for member in self.setup_snapshot_members():
+                tar.add(pjoin(self.dest_dir, member), arcname=member, filter=exclude_installs)
+            # the bootstrap store, when it is not in the prefix
+            if os.path.isdir(bootstrap_root) and \
+               not bootstrap_root.startswith(self.dest_dir + os.sep):
+                tar.add(bootstrap_root, arcname="bootstrap")
+            info = json.dumps({"dest_dir": self.dest_dir,
+                               "bootstrap_root": bootstrap_root}).encode("utf8")
+            tarinfo = tarfile.TarInfo("uberenv_setup_snapshot.json")
+            tarinfo.size = len(info)
+            tar.addfile(tarinfo, io.BytesIO(info))
+        os.replace(tmp, snapshot)
+
+    def restore_setup_snapshot(self):
+        """
+        Extracts the matching setup snapshot into the prefix, if there is one
+        and the prefix has no spack setup yet. Paths of the saving prefix are
+        replaced in the spack config and setup records.
+        """
+        snapshot = self.setup_snapshot_path(self.args["restore_setup_snapshot"])
+        spack_setup = self.spack_config_scope_path() if self.spack_root is not None else self.dest_spack
+        if os.path.exists(spack_setup):
+            print("[info: {0} already exists, not restoring a setup snapshot]".format(spack_setup))
+            return
+        if not os.path.isfile(snapshot):
+            print("[info: no setup snapshot {0}]".format(snapshot))
+            return
+        print("[restoring setup snapshot {0}]".format(snapshot))
+        bootstrap_root = os.path.dirname(self.bootstrap_store_path())
+        extract = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+        with tarfile.open(snapshot, "r:gz") as tar:
+            info = json.load(tar.extractfile("uberenv_setup_snapshot.json"))
+            members = []
+            bootstrap = []
+            for member in tar.getmembers():
+                if member.name == "bootstrap" or member.name.startswith("bootstrap/"):
+                    bootstrap.append(member)
+                elif member.name != "uberenv_setup_snapshot.json":
+                    members.append(member)
+            tar.extractall(self.dest_dir, members=members, **extract)
+            # bootstrapped binaries can not be moved, only restored to the
+            # same bootstrap root, and only if it has no store yet
+            if bootstrap and bootstrap_root == info["bootstrap_root"] and \
+               not os.path.isdir(self.bootstrap_store_path()):
+                print("[restoring spack bootstrap store {0}]".format(self.bootstrap_store_path()))
+                for member in bootstrap:
+                    member.name = os.path.relpath(member.name, "bootstrap")
+                tar.extractall(bootstrap_root, members=bootstrap, **extract)
+            elif bootstrap:
+                print("[info: not restoring the spack bootstrap store of the snapshot to {0}]".format(bootstrap_root))
+
+        # relocate
+        old_dest_dir = info["dest_dir"]
+        if old_dest_dir != self.dest_dir:
+            config_dir = self.spack_config_scope_path() if self.spack_root is not None \
+                         else pjoin(self.dest_spack, "etc", "spack")
+            config_files = glob.glob(pjoin(config_dir, "**", "*.yaml"), recursive=True)
+            config_files += [pjoin(self.dest_dir, f) for f in self.setup_snapshot_files]
+            for config_file in config_files:
+                if not os.path.isfile(config_file):
+                    continue
+                with open(config_file) as f:
+                    content = f.read()
+                if old_dest_dir in content:
+                    with open(config_file, "w") as f:
+                        f.write(content.replace(old_dest_dir, self.dest_dir))
+        # the builtin repo config is tied to the spack checkout's inode
+        settings_file = pjoin(self.dest_dir, ".uberenv_builtin_repo.json")
+        settings = load_state(settings_file)
+        if settings is not None:
+            settings["spack_inode"] = os.stat(self.dest_spack).st_ino
+            save_state(settings_file, settings)
+        # (set in setup_paths_and_dirs when the checkout already exists)
+        if self.spack_root is None:
+            self.use_spack_disable_local_config()
 
     def append_path_to_packages_paths(self, path, errorOnNonexistant=True):
         path = pabs(path)
@@ -711,6 +2448,10 @@ class SpackEnv(UberEnv):
 
         UberEnv.setup_paths_and_dirs(self)
 
+        # Point the project's spack settings at an air-gapped bundle
+        if self.args["import_bundle"] is not None:
+            self.import_bundle()
+
         # Next to uberenv.py (backwards compatibility)
         spack_configs_path = pabs(pjoin(self.uberenv_path,"spack_config"))
 
@@ -723,12 +2464,49 @@ class SpackEnv(UberEnv):
                     print("[ERROR: Given path in 'spack_configs_path' does not exist: {0}]".format(spack_configs_path))
                     sys.exit(-1)
 
+        self.spack_configs_path = spack_configs_path
+
+        # Optional shared cache of compiler and external discovery
+        self.discovery_cache_path = self.set_from_args_or_json("discovery_cache")
+        if self.discovery_cache_path is not None:
+            self.discovery_cache_path = pabs(self.discovery_cache_path)
+
+        # Optional shared cache of concretized environments
+        self.concretize_cache_path = self.set_from_args_or_json("concretize_cache")
+        if self.concretize_cache_path is not None:
+            self.concretize_cache_path = pabs(self.concretize_cache_path)
+
+        # Optional bootstrap store and local bootstrap mirror
+        self.spack_bootstrap_root = self.set_from_args_or_json("spack_bootstrap_root")
+        if self.spack_bootstrap_root is not None:
+            self.spack_bootstrap_root = pabs(self.spack_bootstrap_root)
+        self.spack_bootstrap_mirror = self.set_from_args_or_json("spack_bootstrap_mirror")
+        if self.spack_bootstrap_mirror is not None:
+            self.spack_bootstrap_mirror = pabs(self.spack_bootstrap_mirror)
+            if not os.path.isdir(pjoin(self.spack_bootstrap_mirror, "metadata")):
+                print("[ERROR: No spack bootstrap mirror metadata found in {0}]".format(self.spack_bootstrap_mirror))
+                sys.exit(-1)
+
+        # Optional object store the spack checkout is a worktree of
+        self.spack_object_store = self.set_from_args_or_json("spack_object_store")
+        if self.spack_object_store is not None:
+            self.spack_object_store = pabs(self.spack_object_store)
+
+        # Optional read-only spack checkout, used instead of cloning spack
+        self.spack_root = self.set_from_args_or_json("spack_root")
+        if self.spack_root is not None:
+            self.spack_root = pabs(self.spack_root)
+            if not os.path.isfile(pjoin(self.spack_root, "bin", "spack")):
+                print("[ERROR: No spack checkout found in spack_root: {0}]".format(self.spack_root))
+                sys.exit(-1)
+            if self.spack_object_store is not None:
+                print("[ERROR: spack_root and spack_object_store can not be used together]")
+                sys.exit(-1)
+
         # Set spack_env_directory to absolute path and (if exists) check validity
         self.spack_env_name = self.args["spack_env_name"]
+        # (an existing environment is reused or rebuilt in create_spack_env)
         self.spack_env_directory = pabs(os.path.join(self.dest_dir, self.spack_env_name))
-        if os.path.exists(self.spack_env_directory) and not self.args["skip_setup_and_env"]:
-            print("Removing old Spack Environment Directory: {0}".format(self.spack_env_directory))
-            shutil.rmtree(self.spack_env_directory)
 
         # Setup path of Spack Environment file if not specified on command line
         # Check under spack_config_path -> detected platform -> spack.yaml/ .lock
@@ -783,9 +2561,17 @@ class SpackEnv(UberEnv):
 
         print("[installing to: {0}]".format(self.dest_dir))
 
-        self.dest_spack = pjoin(self.dest_dir,"spack")
-        if os.path.isdir(self.dest_spack):
-            print("[info: destination '{0}' already exists]".format(self.dest_spack))
+        if self.spack_root is not None:
+            print("[info: using spack checkout {0}]".format(self.spack_root))
+            self.dest_spack = self.spack_root
+            self.use_spack_prefix_config()
+        else:
+            self.dest_spack = pjoin(self.dest_dir,"spack")
+            if os.path.isdir(self.dest_spack):
+                print("[info: destination '{0}' already exists]".format(self.dest_spack))
+                # also needed when setup is skipped, config.py is never patched
+                # for spack versions that support it
+                self.use_spack_disable_local_config()
 
         if self.build_mode == "dev-build":
             self.pkg_src_dir = os.path.abspath(os.path.join(self.uberenv_path,self.pkg_src_dir))
@@ -793,66 +2579,130 @@ class SpackEnv(UberEnv):
                 print("[ERROR: package_source_dir '{0}' does not exist]".format(self.pkg_src_dir))
                 sys.exit(-1)
 
-    def find_spack_pkg_path_from_hash(self, pkg_name, pkg_hash):
-        res, out = sexe("{0} find -p /{1}".format(self.spack_exe(), pkg_hash), ret_output = True)
-        for l in out.split("\n"):
+    def find_spack_pkg_path_lines(self, pkg_name, spack_args):
+        """
+        Returns the install path of the first package named pkg_name that
+        `spack find -p` lists, or None.
+        """
+        found = []
+        def find_path(l):
             # TODO: at least print a warning when several choices exist. This will
             # pick the first in the list.
-            if l.startswith(pkg_name) and len(l.split()) > 1:
-                return {"name": pkg_name, "path": l.split()[-1]}
+            if not found and l.startswith(pkg_name) and len(l.split()) > 1:
+                found.append({"name": pkg_name, "path": l.split()[-1]})
+        self.spack_sexe("find -p {0}".format(spack_args), ret_output=True, parsers=[find_path])
+        return found[0] if found else None
+
+    def find_spack_env_prefixes(self):
+        """
+        Returns the install paths of all packages `spack find -p` lists in
+        the Spack Environment.
+        """
+        prefixes = []
+        def find_prefix(l):
+            parts = l.split()
+            if len(parts) > 1 and os.path.isabs(parts[-1]):
+                prefixes.append(parts[-1])
+        self.spack_sexe("find -p", ret_output=True, parsers=[find_prefix])
+        return sorted(set(prefixes))
+
+    def find_spack_pkg_path_from_hash(self, pkg_name, pkg_hash):
+        pkg_path = self.find_spack_pkg_path_lines(pkg_name, "/{0}".format(pkg_hash))
+        if pkg_path is not None:
+            return pkg_path
         print("[ERROR: Failed to find package from hash named '{0}' with hash '{1}']".format(pkg_name, pkg_hash))
         sys.exit(-1)
 
     def find_spack_pkg_path(self, pkg_name, spec = ""):
-        res, out = sexe("{0} find -p {1}".format(self.spack_exe(),self.pkg_name_with_spec), ret_output = True)
-        for l in out.split("\n"):
-            # TODO: at least print a warning when several choices exist. This will
-            # pick the first in the list.
-            if l.startswith(pkg_name) and len(l.split()) > 1:
-                return {"name": pkg_name, "path": l.split()[-1]}
+        pkg_path = self.find_spack_pkg_path_lines(pkg_name, self.pkg_name_with_spec)
+        if pkg_path is not None:
+            return pkg_path
         print("[ERROR: Failed to find package from spec named '{0}' with spec '{1}']".format(pkg_name, spec))
         sys.exit(-1)
 
     def clone_repo(self):
-        if not os.path.isdir(self.dest_spack):
-
-            # compose clone command for the dest path, spack url and branch
-            print("[info: cloning spack develop branch from github]")
-
-            os.chdir(self.dest_dir)
-
-            clone_args = ("-c http.sslVerify=false "
-                          if self.args["ignore_ssl_errors"] else "")
+        # the spack checkout may change below
+        self.stop_spack_session()
+
+        clone_args = ("-c http.sslVerify=false "
+                      if self.args["ignore_ssl_errors"] else "")
+        spack_url = self.project_args.get("spack_url", "https://github.com/spack/spack.git")
+
+        if self.spack_root is not None:
+            self.check_spack_root()
+        elif not os.path.isdir(self.dest_spack) and self.spack_object_store is not None:
+            self.add_spack_worktree(spack_url, clone_args)
+        elif not os.path.isdir(self.dest_spack):
+            # git -C instead of changing directories, other phases may run
+            # at the same time
+            git = "git -C {0} ".format(self.dest_spack)
+            if "spack_commit" in self.project_args:
+                # fetch only the pinned commit, instead of cloning the tip
+                # of the branch and fetching the commit afterwards
+                sha1 = self.project_args["spack_commit"]
+                print("[info: fetching spack commit {0}]".format(sha1))
+                res = sexe("git init -q {0}".format(self.dest_spack), echo=True)
+                if res == 0:
+                    res = sexe(git + "remote add origin {0}".format(spack_url), echo=True)
+                if res == 0:
+                    res = sexe(git + "{0}fetch --depth=1 origin {1}".format(clone_args, sha1), echo=True)
+                if res == 0:
+                    res = sexe(git + "checkout -q --detach FETCH_HEAD", echo=True)
+                if res != 0:
+                    print("[ERROR: Git failed to fetch Spack commit {0}]".format(sha1))
+                    shutil.rmtree(self.dest_spack)
+                    sys.exit(-1)
+            else:
+                # compose clone command for the dest path, spack url and branch
+                print("[info: cloning spack develop branch from github]")
 
-            spack_url = self.project_args.get("spack_url", "https://github.com/spack/spack.git")
-            spack_branch = self.project_args.get("spack_branch", "develop")
+                spack_branch = self.project_args.get("spack_branch", "develop")
 
-            clone_cmd =  "git {0} clone --single-branch --depth=1 -b {1} {2} spack".format(clone_args, spack_branch, spack_url)
-            res = sexe(clone_cmd, echo=True)
-            if res != 0:
-                print("[ERROR: Git failed to clone Spack repository]")
-                sys.exit(-1)
+                clone_cmd =  "git {0} clone --single-branch --depth=1 -b {1} {2} {3}".format(
+                             clone_args, spack_branch, spack_url, self.dest_spack)
+                res = sexe(clone_cmd, echo=True)
+                if res != 0:
+                    print("[ERROR: Git failed to clone Spack repository]")
+                    sys.exit(-1)
 
-        if "spack_commit" in self.project_args:
-            # optionally, check out a specific commit
-            os.chdir(pjoin(self.dest_dir,"spack"))
+        if "spack_commit" in self.project_args and self.spack_root is None:
+            # optionally, check out a specific commit. Checked without
+            # network access, only fetched if it is not there yet.
+            git = "git -C {0} ".format(self.dest_spack)
             sha1 = self.project_args["spack_commit"]
-            res, current_sha1 = sexe("git log -1 --pretty=%H", ret_output=True)
-            if sha1 != current_sha1:
+            current_sha1 = read_git_head(self.dest_spack)
+            if current_sha1 is None:
+                res, current_sha1 = sexe(git + "rev-parse HEAD", ret_output=True)
+                current_sha1 = current_sha1.strip()
+            if not current_sha1.startswith(sha1):
                 print("[info: using spack commit {0}]".format(sha1))
-                sexe("git stash", echo=True)
-                sexe("git fetch --depth=1 origin {0}".format(sha1),echo=True)
-                res = sexe("git checkout {0}".format(sha1),echo=True)
+                sexe(git + "stash", echo=True)
+                # (from spack_url rather than origin: a worktree has no remote,
+                # and an imported bundle replaces spack_url)
+                with self.spack_object_store_lock():
+                    res, _ = sexe(git + "cat-file -e {0}^{{commit}}".format(sha1), ret_output=True)
+                    if res != 0:
+                        sexe(git + "{0}fetch --depth=1 {1} {2}".format(clone_args, spack_url, sha1),echo=True)
+                res = sexe(git + "checkout {0}".format(sha1),echo=True)
                 if res != 0:
                     # Usually untracked files that would be overwritten
                     print("[ERROR: Git failed to checkout]")
                     sys.exit(-1)
 
-        if self.args["repo_pull"]:
+        if self.args["repo_pull"] and self.spack_root is None:
             # do a pull to make sure we have the latest
-            os.chdir(pjoin(self.dest_dir,"spack"))
-            sexe("git stash", echo=True)
-            res = sexe("git pull", echo=True)
+            git = "git -C {0} ".format(self.dest_spack)
+            sexe(git + "stash", echo=True)
+            if self.spack_object_store is None:
+                res = sexe(git + "pull", echo=True)
+            else:
+                # worktrees are detached, fetch the branch into the store
+                spack_branch = self.project_args.get("spack_branch", "develop")
+                with self.spack_object_store_lock():
+                    res = sexe(git + "{0}fetch --depth=1 {1} {2}".format(clone_args, spack_url, spack_branch),
+                               echo=True)
+                if res == 0:
+                    res = sexe(git + "checkout -q --detach FETCH_HEAD", echo=True)
             if res != 0:
                 # Usually untracked files that would be overwritten
                 print("[ERROR: Git failed to pull]")
@@ -860,213 +2710,1026 @@ class SpackEnv(UberEnv):
 
         # Move and checkout Spack builtin package repository if not included in Spack repo
         if not os.path.exists(pjoin(self.dest_spack, "var", "spack", "repos", "builtin")):
-            packages_repo = pjoin(self.dest_dir, "builtin_spack_packages_repo")
-
-            print(f"[info: moving spack builtin package repository to {packages_repo}]")
-            spack_repo_set_cmd = f"{self.spack_exe(use_spack_env=False)} repo set --destination {packages_repo} builtin"
-            res = sexe(spack_repo_set_cmd, echo=True)
-            if res != 0:
-                print("[ERROR: Failed to set builtin package repository destination]")
-                sys.exit(-1)
-
-            # Optionally, check out Spack's builtin package repo to a specific commit/branch/tag
-            if "spack_packages_url" in self.project_args:
-                spack_repo_remove_cmd = f"{self.spack_exe(use_spack_env=False)} repo remove builtin"
-                res = sexe(spack_repo_remove_cmd, echo=True)
+            packages_repo = self.builtin_packages_repo_path()
+
+            # The repo config only has to be written once per spack checkout
+            settings = {"spack": read_git_head(self.dest_spack),
+                        "spack_inode": os.stat(self.dest_spack).st_ino,
+                        "destination": packages_repo,
+                        "url": self.project_args.get("spack_packages_url")}
+            settings_file = pjoin(self.dest_dir, ".uberenv_builtin_repo.json")
+            previous = load_state(settings_file)
+            remove_state(settings_file)
+
+            if previous == settings:
+                print(f"[info: spack builtin package repository is already configured at {packages_repo}]")
+            else:
+                print(f"[info: moving spack builtin package repository to {packages_repo}]")
+                spack_repo_set_cmd = f"repo set --destination {packages_repo} builtin"
+                res = self.spack_sexe(spack_repo_set_cmd, use_spack_env=False, echo=True)
                 if res != 0:
-                    print("[ERROR: Failed to remove builtin package repository so it could be re-added with given URL]")
+                    print("[ERROR: Failed to set builtin package repository destination]")
                     sys.exit(-1)
 
-                # Now add it back with the correct url
-                url = self.project_args["spack_packages_url"]
-                spack_repo_add_cmd = f"{self.spack_exe(use_spack_env=False)} repo add --name builtin {url}"
-                res = sexe(spack_repo_add_cmd, echo=True)
-                if res != 0:
-                    print("[ERROR: Failed to add builtin package repository with given URL]")
-                    sys.exit(-1)
+                # Optionally, check out Spack's builtin package repo to a specific commit/branch/tag
+                if "spack_packages_url" in self.project_args:
+                    spack_repo_remove_cmd = "repo remove builtin"
+                    res = self.spack_sexe(spack_repo_remove_cmd, use_spack_env=False, echo=True)
+                    if res != 0:
+                        print("[ERROR: Failed to remove builtin package repository so it could be re-added with given URL]")
+                        sys.exit(-1)
+
+                    # Now add it back with the correct url
+                    url = self.project_args["spack_packages_url"]
+                    spack_repo_add_cmd = f"repo add --name builtin {url}"
+                    res = self.spack_sexe(spack_repo_add_cmd, use_spack_env=False, echo=True)
+                    if res != 0:
+                        print("[ERROR: Failed to add builtin package repository with given URL]")
+                        sys.exit(-1)
+
+            if self.args["spack_packages_sparse"] and not os.path.isdir(packages_repo):
+                self.clone_sparse_builtin_repo(packages_repo)
 
             # Optionally, check out Spack's builtin package repo to a specific commit/branch/tag
-            if "spack_packages_commit" in self.project_args:
+            if self.builtin_repo_is_current():
+                print(f"[info: spack builtin package repository is already at {read_git_head(packages_repo)}]")
+            elif "spack_packages_commit" in self.project_args:
                 sha1 = self.project_args["spack_packages_commit"]
 
-                spack_repo_update_cmd = f"{self.spack_exe(use_spack_env=False)} repo update --commit {sha1} builtin"
-                res = sexe(spack_repo_update_cmd, echo=True)
+                spack_repo_update_cmd = f"repo update --commit {sha1} builtin"
+                res = self.spack_sexe(spack_repo_update_cmd, use_spack_env=False, echo=True)
                 if res != 0:
                     print("[ERROR: Failed to update git commit for builtin package repository]")
                     sys.exit(-1)
             elif "spack_packages_branch" in self.project_args:
                 branch = self.project_args["spack_packages_branch"]
 
-                spack_repo_update_cmd = f"{self.spack_exe(use_spack_env=False)} repo update --branch {branch} builtin"
-                res = sexe(spack_repo_update_cmd, echo=True)
+                spack_repo_update_cmd = f"repo update --branch {branch} builtin"
+                res = self.spack_sexe(spack_repo_update_cmd, use_spack_env=False, echo=True)
                 if res != 0:
                     print("[ERROR: Failed to update git branch for builtin package repository]")
                     sys.exit(-1)
             elif "spack_packages_tag" in self.project_args:
                 tag = self.project_args["spack_packages_tag"]
 
-                spack_repo_update_cmd = f"{self.spack_exe(use_spack_env=False)} repo update --tag {tag} builtin"
-                res = sexe(spack_repo_update_cmd, echo=True)
+                spack_repo_update_cmd = f"repo update --tag {tag} builtin"
+                res = self.spack_sexe(spack_repo_update_cmd, use_spack_env=False, echo=True)
                 if res != 0:
                     print("[ERROR: Failed to update git tag for builtin package repository]")
                     sys.exit(-1)
             else:
                 print("[info: User did not specify any `spack_packages_*` override, Spack will pull the default ref of spack-packages]")
 
+            save_state(settings_file, settings)
+            # (the env's own `repo update` can be skipped when this holds)
+            self.builtin_repo_current = self.builtin_repo_is_current()
+
+    def check_spack_root(self):
+        """
+        Checks that the read-only spack checkout is at the pinned commit
+        (or branch). It is never updated.
+        """
+        head = read_git_head(self.spack_root)
+        if "spack_commit" in self.project_args:
+            sha1 = self.project_args["spack_commit"]
+            if head is None or not head.startswith(sha1):
+                print("[ERROR: spack_root {0} is at commit {1}, the project needs spack commit {2}]".format(
+                      self.spack_root, head, sha1))
+                sys.exit(-1)
+        elif "spack_branch" in self.project_args:
+            branch = read_git_branch(self.spack_root)
+            if branch != self.project_args["spack_branch"]:
+                print("[WARNING: spack_root {0} is on branch {1}, the project uses spack branch {2}]".format(
+                      self.spack_root, branch, self.project_args["spack_branch"]))
+        if self.args["repo_pull"]:
+            print("[WARNING: --pull is ignored, spack_root {0} is not updated]".format(self.spack_root))
+        print("[info: using spack commit {0} of {1}]".format(head, self.spack_root))
+
+    def spack_object_store_lock(self):
+        """
+        Serializes fetches into the spack object store between uberenv runs.
+        """
+        if self.spack_object_store is None:
+            # nothing to lock, an empty ExitStack does nothing
+            return contextlib.ExitStack()
+        if not os.path.isdir(self.spack_object_store):
+            os.makedirs(self.spack_object_store)
+        return file_lock(pjoin(self.spack_object_store, "uberenv.lock"))
+
+    def add_spack_worktree(self, spack_url, clone_args):
+        """
+        Creates the spack checkout as a worktree of the shared object store.
+        The pinned commit is only fetched if no other prefix has fetched it
+        before, the develop branch (or spack_branch) is always fetched.
+        """
+        store = self.spack_object_store
+        git = "git -C {0} ".format(store)
+        with self.spack_object_store_lock():
+            if not os.path.isdir(pjoin(store, "objects")):
+                print("[info: creating spack object store {0}]".format(store))
+                res = sexe("git init -q --bare {0}".format(store), echo=True)
+                if res != 0:
+                    print("[ERROR: Git failed to create spack object store {0}]".format(store))
+                    sys.exit(-1)
+            # forget the worktrees of removed prefixes
+            sexe(git + "worktree prune", echo=True)
+
+            if "spack_commit" in self.project_args:
+                rev = self.project_args["spack_commit"]
+                res, _ = sexe(git + "cat-file -e {0}^{{commit}}".format(rev), ret_output=True)
+                if res == 0:
+                    print("[info: spack commit {0} found in object store]".format(rev))
+                else:
+                    print("[info: fetching spack commit {0} into object store]".format(rev))
+                    res = sexe(git + "{0}fetch --depth=1 {1} {2}".format(clone_args, spack_url, rev), echo=True)
+            else:
+                spack_branch = self.project_args.get("spack_branch", "develop")
+                print("[info: fetching spack {0} branch into object store]".format(spack_branch))
+                res = sexe(git + "{0}fetch --depth=1 {1} {2}".format(clone_args, spack_url, spack_branch), echo=True)
+                rev = "FETCH_HEAD"
+
+            if res == 0:
+                res = sexe(git + "worktree add -q --detach {0} {1}".format(self.dest_spack, rev), echo=True)
+            if res != 0:
+                print("[ERROR: Git failed to add spack worktree {0} from object store {1}]".format(self.dest_spack, store))
+                sys.exit(-1)
+
+    def clone_sparse_builtin_repo(self, packages_repo):
+        """
+        Clones the builtin packages repo at its pinned ref without file
+        contents (blob filter), and checks out only the packages needed for
+        our specs, see sparse_packages_add().
+        """
+        url = self.project_args.get("spack_packages_url", "https://github.com/spack/spack-packages.git")
+        # tags and branches are fetched into local refs of the same name, so
+        # that builtin_repo_is_current() finds them
+        ref, refspec, checkout = "HEAD", "HEAD", "--detach FETCH_HEAD"
+        if "spack_packages_commit" in self.project_args:
+            ref = refspec = self.project_args["spack_packages_commit"]
+        elif "spack_packages_tag" in self.project_args:
+            ref = self.project_args["spack_packages_tag"]
+            refspec = "refs/tags/{0}:refs/tags/{0}".format(ref)
+        elif "spack_packages_branch" in self.project_args:
+            ref = checkout = self.project_args["spack_packages_branch"]
+            refspec = "+refs/heads/{0}:refs/heads/{0}".format(ref)
+        clone_args = ("-c http.sslVerify=false "
+                      if self.args["ignore_ssl_errors"] else "")
+        print("[info: partially cloning {0} ({1}) into {2}]".format(url, ref, packages_repo))
+        git = "git -C {0} ".format(packages_repo)
+        for cmd in ["git init -q {0}".format(packages_repo),
+                    git + "remote add origin {0}".format(url),
+                    git + "config remote.origin.promisor true",
+                    git + "config remote.origin.partialclonefilter blob:none",
+                    git + "{0}fetch --depth=1 --filter=blob:none origin {1}".format(clone_args, refspec),
+                    git + "sparse-checkout set --cone"]:
+            res = sexe(cmd, echo=True)
+            if res != 0:
+                print("[ERROR: Failed to partially clone builtin package repository]")
+                shutil.rmtree(packages_repo, ignore_errors=True)
+                sys.exit(-1)
+
+        # the packages of our specs, of the packages in our own repos (they
+        # may derive from builtin ones) and of a previous concretization
+        names = [self.pkg_name] + spec_package_names(self.args["spec"])
+        for packages_path in self.packages_paths:
+            for pkg in os.listdir(packages_path):
+                names.append(pkg)
+                package_py = pjoin(packages_path, pkg, "package.py")
+                if os.path.isfile(package_py):
+                    with open(package_py) as f:
+                        names += package_py_dependencies(f.read())
+        spack_lock = pjoin(self.spack_env_directory, "spack.lock")
+        if os.path.isfile(spack_lock):
+            try:
+                lock = load_json_file(spack_lock)
+                names += [spec["name"] for spec in lock.get("concrete_specs", {}).values()]
+            except (ValueError, KeyError, TypeError):
+                pass
+
+        res = sexe(git + "checkout -q {0}".format(checkout), echo=True)
+        if res != 0:
+            print("[ERROR: Failed to check out builtin package repository]")
+            shutil.rmtree(packages_repo, ignore_errors=True)
+            sys.exit(-1)
+        self.sparse_packages_add(names)
+
+    def sparse_packages_dir(self):
+        """
+        Path of the packages directory of the builtin repo (relative to its
+        git root), the package directories it holds and those checked out.
+        """
+        if self.sparse_packages is None:
+            packages_repo = self.builtin_packages_repo_path()
+            packages_dir = None
+            for candidate in ("repos/spack_repo/builtin/packages", "repos/builtin/packages", "packages"):
+                res, _ = sexe("git -C {0} cat-file -e HEAD:{1}".format(packages_repo, candidate),
+                              ret_output=True)
+                if res == 0:
+                    packages_dir = candidate
+                    break
+            if packages_dir is None:
+                print("[ERROR: Failed to find the packages of the builtin package repository]")
+                sys.exit(-1)
+            pkg_dirs = set()
+            sexe("git -C {0} ls-tree -d --name-only HEAD:{1}".format(packages_repo, packages_dir),
+                 ret_output=True, parsers=[lambda line: pkg_dirs.add(line.strip())])
+            # what earlier runs already checked out
+            included = set()
+            def add_included(line):
+                if os.path.dirname(line.strip()) == packages_dir:
+                    included.add(os.path.basename(line.strip()))
+            sexe("git -C {0} sparse-checkout list".format(packages_repo),
+                 ret_output=True, parsers=[add_included])
+            self.sparse_packages = (packages_dir, pkg_dirs, included)
+        return self.sparse_packages
+
+    def sparse_virtual_providers(self):
+        """
+        Preferred providers of virtual packages (mpi, blas, c, ...) from
+        spack's packages config, empty if spack can not tell.
+        """
+        if self.sparse_providers is None:
+            script = ("import json, spack.config\n"
+                      "providers = spack.config.get('packages:all:providers', {}) or {}\n"
+                      "print('[uberenv providers: ' + json.dumps(providers) + ']')")
+            res, out = self.spack_sexe("python -c {0}".format(shlex.quote(script)),
+                                       use_spack_env=False, ret_output=True)
+            self.sparse_providers = {}
+            for line in out.splitlines():
+                if res == 0 and line.startswith("[uberenv providers: "):
+                    self.sparse_providers = json.loads(line[len("[uberenv providers: "):-1])
+        return self.sparse_providers
+
+    def sparse_packages_add(self, names):
+        """
+        Adds packages, and the builtin packages they depend on (as far as
+        can be seen from their package.py), to the sparse checkout of the
+        builtin repo. Virtual packages add their first preferred provider.
+        Returns the number of package directories added.
+        """
+        packages_repo = self.builtin_packages_repo_path()
+        packages_dir, pkg_dirs, included = self.sparse_packages_dir()
+        root = os.path.dirname(packages_dir)
+
+        def package_dir(name):
+            # newer repos name the directories like python modules
+            pkg_dir = name.replace("-", "_")
+            if pkg_dir[:1].isdigit():
+                pkg_dir = "_" + pkg_dir
+            if keyword.iskeyword(pkg_dir):
+                pkg_dir += "_"
+            for candidate in (name, pkg_dir):
+                if candidate in pkg_dirs:
+                    return candidate
+            return None
+
+        added = 0
+        pending = set(names)
+        while pending:
+            new_dirs = set()
+            for name in pending:
+                candidate = package_dir(name)
+                if candidate is None:
+                    # a virtual, e.g. depends_on("mpi")
+                    for provider in self.sparse_virtual_providers().get(name, []):
+                        candidate = package_dir(re.split(r"[@%+~^ ]", provider.strip())[0])
+                        if candidate is not None:
+                            break
+                if candidate is not None and candidate not in included:
+                    new_dirs.add(candidate)
+            if not new_dirs:
+                break
+            included.update(new_dirs)
+            added += len(new_dirs)
+            dirs = [pjoin(root, "build_systems")] + \
+                   [pjoin(packages_dir, d) for d in sorted(included)]
+            print("[info: sparse builtin package repository: {0} packages]".format(len(included)))
+            res = sexe("git -C {0} sparse-checkout set --cone {1}".format(packages_repo, " ".join(dirs)))
+            if res != 0:
+                print("[ERROR: Failed to update sparse checkout of builtin package repository]")
+                sys.exit(-1)
+            # follow dependencies of what was just added
+            pending = set()
+            for d in new_dirs:
+                package_py = pjoin(packages_repo, packages_dir, d, "package.py")
+                if not os.path.isfile(package_py):
+                    continue
+                with open(package_py) as f:
+                    pending.update(package_py_dependencies(f.read()))
+        return added
+
+    def builtin_repo_is_sparse(self):
+        # True while the builtin repo is a sparse checkout
+        res, out = sexe("git -C {0} config --bool core.sparseCheckout".format(self.builtin_packages_repo_path()),
+                        ret_output=True)
+        return res == 0 and out.strip() == "true"
+
+    def builtin_repo_is_current(self):
+        """
+        True if the builtin packages repo is already checked out at its
+        spack_packages_commit/_tag/_branch, checked from its git metadata
+        without spack. Branches (and the default ref) only count as current
+        without --pull.
+        """
+        packages_repo = self.builtin_packages_repo_path()
+        head = read_git_head(packages_repo)
+        if head is None:
+            return False
+        if "spack_packages_commit" in self.project_args:
+            return head.startswith(self.project_args["spack_packages_commit"])
+        if "spack_packages_tag" in self.project_args:
+            tag = self.project_args["spack_packages_tag"]
+            res, out = sexe("git -C {0} rev-parse -q --verify {1}^{{commit}}".format(packages_repo, tag),
+                            ret_output=True)
+            return res == 0 and out.strip() == head
+        if self.args["repo_pull"]:
+            return False
+        if "spack_packages_branch" in self.project_args:
+            return read_git_branch(packages_repo) == self.project_args["spack_packages_branch"]
+        return True
+
+
+    # Statement in config.py of spack versions that read SPACK_DISABLE_LOCAL_CONFIG
+    spack_disable_env_stmt = 'disable_local_config = "SPACK_DISABLE_LOCAL_CONFIG" in os.environ'
+
+    def use_spack_disable_local_config(self):
+        """
+        Sets SPACK_DISABLE_LOCAL_CONFIG for all spack commands if the
+        spack checkout supports it, returns True if so.
+        """
+        spack_lib_config = pjoin(self.dest_spack,"lib","spack","spack","config.py")
+        if not os.path.isfile(spack_lib_config):
+            return False
+        with open(spack_lib_config) as f:
+            if self.spack_disable_env_stmt not in f.read():
+                return False
+        # (a running spack session restarts when SPACK_* variables change)
+        os.environ["SPACK_DISABLE_LOCAL_CONFIG"] = "1"
+        return True
+
+    def spack_prefix_config_path(self):
+        # stands in for ~/.spack when spack_root is used
+        return pjoin(self.dest_dir, ".spack")
+
+    def spack_config_scope_path(self):
+        # directory of spack_config_scope
+        if self.spack_root is not None:
+            return self.spack_prefix_config_path()
+        return pjoin(self.dest_spack, "etc", "spack", "defaults")
+
+    def use_spack_prefix_config(self):
+        """
+        Points spack's user config and cache scope into the prefix, for a
+        read-only spack checkout. Our settings go into this scope instead
+        of the checkout's "defaults" scope. The system scope (/etc/spack)
+        points at an empty directory in the prefix, SPACK_DISABLE_LOCAL_CONFIG
+        can not be used since it also disables the user scope. Python does
+        not write bytecode into the checkout.
+        """
+        os.environ["SPACK_USER_CONFIG_PATH"] = self.spack_prefix_config_path()
+        os.environ["SPACK_USER_CACHE_PATH"] = self.spack_prefix_config_path()
+        os.environ["SPACK_SYSTEM_CONFIG_PATH"] = pjoin(self.spack_prefix_config_path(), "system")
+        os.environ["SPACK_GNUPGHOME"] = pjoin(self.spack_prefix_config_path(), "gpg")
+        # spack imports lib/spack from the checkout, which would otherwise
+        # get __pycache__ directories (PYTHONPYCACHEPREFIX needs python 3.8)
+        os.environ["PYTHONDONTWRITEBYTECODE"] = "1"
+        if os.environ.pop("SPACK_DISABLE_LOCAL_CONFIG", None) is not None:
+            print("[WARNING: Unsetting SPACK_DISABLE_LOCAL_CONFIG, with spack_root uberenv's settings are in spack's user scope]")
+        self.spack_config_scope = "user"
+
+    def write_spack_prefix_config(self):
+        """
+        Moves everything spack writes under its own checkout by default
+        (install tree, source cache, named environments) into the prefix.
+        """
+        config_path = self.spack_prefix_config_path()
+        # (the system scope stays empty)
+        if not os.path.isdir(pjoin(config_path, "system")):
+            os.makedirs(pjoin(config_path, "system"))
+        config_yaml = pjoin(config_path, "config.yaml")
+        print("[redirecting spack install tree and caches into the prefix: {0}]".format(config_yaml))
+        # (only written once, spack commands may add to it later)
+        if os.path.isfile(config_yaml):
+            return
+        with open(config_yaml, "w") as f:
+            f.write("config:\n"
+                    "  install_tree:\n"
+                    "    root: {0}\n"
+                    "  source_cache: {1}\n"
+                    "  environments_root: {2}\n".format(pjoin(self.dest_dir, "opt", "spack"),
+                                                       pjoin(config_path, "source_cache"),
+                                                       pjoin(config_path, "environments")))
 
     def disable_spack_config_scopes(self):
         # disables all config scopes except "defaults", which we will
         # force our settings into
-        spack_lib_config = pjoin(self.dest_spack,"lib","spack","spack","config.py")
-        print("[disabling config scope (except defaults) in: {0}]".format(spack_lib_config))
-        cfg_script = open(spack_lib_config).read()
+        #
+        # With spack_root, the checkout is not touched. Spack's user and
+        # system scopes are moved into the prefix instead (see
+        # use_spack_prefix_config), so neither ~/.spack nor /etc/spack is read.
+        if self.spack_root is not None:
+            self.write_spack_prefix_config()
+            return
         #
         # For newer versions of spack, we can use the SPACK_DISABLE_LOCAL_CONFIG
-        # env var plumbing. We patch it to True to make a permanent change.
+        # env var plumbing, set for every spack command uberenv runs, so
+        # config.py is left untouched.
         #
         # Note: This path does not disable the 'site' config, but disabling 'user' config
         # is our primary goal.
         #
-        spack_disable_env_stmt = 'disable_local_config = "SPACK_DISABLE_LOCAL_CONFIG" in os.environ'
+        if self.use_spack_disable_local_config():
+            print("[disabling config scope (except defaults) with SPACK_DISABLE_LOCAL_CONFIG]")
+            return
+        # For older versions of spack, patch config.py. Only written if
+        # the patch is not there yet: rewriting it would invalidate its
+        # bytecode.
+        spack_lib_config = pjoin(self.dest_spack,"lib","spack","spack","config.py")
+        print("[disabling config scope (except defaults) in: {0}]".format(spack_lib_config))
+        with open(spack_lib_config) as f:
+            orig_cfg_script = f.read()
+        cfg_script = orig_cfg_script
+        # (set by the patch of previous uberenv versions)
         spack_disable_env_stmt_perm = "disable_local_config = True"
-        if cfg_script.count(spack_disable_env_stmt) > 0:
-            cfg_script = cfg_script.replace(spack_disable_env_stmt,
-                                            spack_disable_env_stmt_perm)
-        # path for older versions of spack
-        elif cfg_script.count(spack_disable_env_stmt_perm) == 0:
-            for cfg_scope_stmt in ["('system', os.path.join(spack.paths.system_etc_path, 'spack')),",
-                                "('site', os.path.join(spack.paths.etc_path, 'spack')),",
-                                "('user', spack.paths.user_config_path)"]:
+        cfg_scope_stmts = ["('system', os.path.join(spack.paths.system_etc_path, 'spack')),",
+                           "('site', os.path.join(spack.paths.etc_path, 'spack')),",
+                           "('user', spack.paths.user_config_path)"]
+        if cfg_script.count(spack_disable_env_stmt_perm) == 0:
+            for cfg_scope_stmt in cfg_scope_stmts:
+                cfg_script = cfg_script.replace("#DISABLED BY UBERENV: " + cfg_scope_stmt,
+                                                cfg_scope_stmt)
                 cfg_script = cfg_script.replace(cfg_scope_stmt,
                                                 "#DISABLED BY UBERENV: " + cfg_scope_stmt)
-        open(spack_lib_config,"w").write(cfg_script)
+        if cfg_script == orig_cfg_script:
+            if cfg_script.count(spack_disable_env_stmt_perm) > 0 or \
+               any(cfg_script.count("#DISABLED BY UBERENV: " + stmt) > 0 for stmt in cfg_scope_stmts):
+                print("[config.py is already patched]")
+            else:
+                # neither the env var nor the scope list uberenv knows about,
+                # spack may still honor the env var elsewhere
+                os.environ["SPACK_DISABLE_LOCAL_CONFIG"] = "1"
+                print("[WARNING: Could not disable Spack's config scopes (except defaults), {0} has an "
+                      "unknown layout. Only SPACK_DISABLE_LOCAL_CONFIG is set, settings in ~/.spack "
+                      "may still be used.]".format(spack_lib_config))
+            return
+        with open(spack_lib_config,"w") as f:
+            f.write(cfg_script)
+        # a running spack session has already imported the unpatched config.py
+        self.stop_spack_session()
 
-    def patch(self):
-        # this is an opportunity to show spack python info post obtaining spack
-        self.print_spack_python_info()
+    def use_clingo_setup(self):
+        if "spack_setup_clingo" in self.project_args and self.project_args["spack_setup_clingo"] == False:
+            print("[info: clingo will not be installed by uberenv]")
+            return False
+        return True
+
+    def setup_phases(self):
+        # Same steps as clone_repo, patch and clean_build, but the internet
+        # check runs side by side with the probe of the spack checkout.
+        # Everything waits for the config scope patch, so that no spack
+        # command ever sees the user's config. setup_clingo writes the
+        # bootstrap config, so it waits for the probe reading the config.
+        # clean_build runs after the probe since it removes python caches
+        # other spack commands are using, then spack is precompiled.
+        probes = ["probe_spack"]
+        key = self.setup_inputs_hash
+        phases = []
+        clone_inputs = []
+        # a setup snapshot is restored before anything else
+        if self.args["restore_setup_snapshot"] is not None:
+            phases.append(Phase("restore_setup_snapshot", self.restore_setup_snapshot, key=key))
+            clone_inputs.append("restore_setup_snapshot")
+        phases += [Phase("clone_repo", self.clone_repo, inputs=clone_inputs, checkpoint=True, key=key,
+                         exists=lambda: os.path.isdir(self.dest_spack)),
+                   Phase("disable_spack_config_scopes", self.disable_spack_config_scopes,
+                         inputs=["clone_repo"], key=key),
+                   Phase("probe_spack", self.probe_spack,
+                         inputs=["disable_spack_config_scopes"], key=key)]
+        if self.use_clingo_setup():
+            # The internet check is only needed when bootstrapping without a
+            # local mirror. (setup_clingo checks for internet itself if this
+            # one is skipped, e.g. when clone_repo changes the spack commit)
+            clingo_inputs = ["probe_spack"]
+            if self.spack_bootstrap_mirror is None and self.args["restore_setup_snapshot"] is not None:
+                # the snapshot may hold the bootstrap, only known once restored
+                phases.append(Phase("have_internet", self.check_internet_for_bootstrap,
+                                    inputs=["restore_setup_snapshot"]))
+                clingo_inputs.append("have_internet")
+            elif self.spack_bootstrap_mirror is None and not self.bootstrap_is_complete():
+                phases.append(Phase("have_internet", self.check_internet))
+                clingo_inputs.append("have_internet")
+            phases.append(Phase("setup_clingo", self.setup_clingo,
+                                inputs=clingo_inputs, checkpoint=True, key=key,
+                                exists=self.bootstrap_is_complete))
+            probes.append("setup_clingo")
+        phases.append(Phase("clean_build", self.clean_build, inputs=probes,
+                            checkpoint=True, key=key))
+        # after clean_build, which may remove the python cache
+        if self.args["save_setup_snapshot"] is None:
+            phases.append(Phase("compile_spack", self.compile_spack, inputs=["clean_build"],
+                                outputs=["setup"]))
+        else:
+            phases.append(Phase("compile_spack", self.compile_spack, inputs=["clean_build"]))
+            phases.append(Phase("save_setup_snapshot", self.save_setup_snapshot,
+                                inputs=["compile_spack"], outputs=["setup"]))
+        return phases
 
+    def patch(self):
         # force spack to use only "defaults" config scope
         self.disable_spack_config_scopes()
 
+        # this is an opportunity to show spack python info post obtaining
+        # spack, and check which concretizer this version of Spack has
+        self.probe_spack()
+
         # setup clingo (unless specified not to)
-        if "spack_setup_clingo" in self.project_args and self.project_args["spack_setup_clingo"] == False:
-            print("[info: clingo will not be installed by uberenv]")
-        else:
+        if self.use_clingo_setup():
             self.setup_clingo()
 
-        # Check which concretizer this version of Spack has
-        self.check_concretizer_args()
+    def spack_env_inputs(self):
+        """
+        Describes what the Spack Environment is built from. "base" covers
+        what requires creating the environment from scratch when changed,
+        the other entries can be updated in place.
+        """
+        h = hashlib.sha256()
+        if self.spack_env_file:
+            hash_file(h, self.spack_env_file)
+        h.update(str(read_git_head(self.dest_spack)).encode("utf8"))
+        if self.spack_setup_environment:
+            h.update("generated: {0} {1}".format(self.spack_compiler_paths,
+                                                 self.spack_externals).encode("utf8"))
+        develop = None
+        if self.build_mode == "dev-build":
+            develop = [self.pkg_name,
+                       "{0}@={1}".format(self.pkg_name, self.pkg_version),
+                       self.pkg_src_dir]
+        mirror = None
+        if self.args["mirror"] is not None and not self.args["create_mirror"]:
+            mirror = [self.pkg_name, self.get_mirror_path()]
+        upstream = None
+        if self.args["upstream"] is not None:
+            upstream = [self.pkg_name, pabs(self.args["upstream"])]
+        spec = self.pkg_name + self.args["spec"]
+        if self.args["import_bundle"] is not None:
+            # the environment is created from the bundle's spack.lock and
+            # installed as it is, adding the spec or a develop entry would
+            # make spack concretize again
+            spec = None
+            develop = None
+        return {"base": h.hexdigest(),
+                "repos": [pabs(pjoin(p, "..")) for p in self.packages_paths],
+                "spec": spec,
+                "develop": develop,
+                "mirror": mirror,
+                "upstream": upstream}
+
+    def spack_env_inputs_file(self):
+        return pjoin(self.spack_env_directory, ".uberenv_env_inputs.json")
+
+    def read_spack_env_inputs(self):
+        # returns the inputs the existing environment was built from, if any
+        if not os.path.isfile(pjoin(self.spack_env_directory, "spack.yaml")):
+            return None
+        return load_state(self.spack_env_inputs_file())
 
     def create_spack_env(self):
+        inputs = self.spack_env_inputs()
+        previous = self.read_spack_env_inputs()
+
+        empty = {"repos": [], "spec": None, "develop": None,
+                 "mirror": None, "upstream": None}
+        reused = previous is not None and previous.get("base") == inputs["base"]
+        if reused:
+            print("[reusing spack env {0}]".format(self.spack_env_directory))
+            previous = dict(empty, **previous)
+            # forces a rebuild next time if we fail half way through
+            remove_state(self.spack_env_inputs_file())
+        else:
+            if os.path.exists(self.spack_env_directory):
+                print("Removing old Spack Environment Directory: {0}".format(self.spack_env_directory))
+                shutil.rmtree(self.spack_env_directory)
+            self.new_spack_env()
+            previous = empty
+
+        if reused and self.builtin_repo_current:
+            print("[info: spack builtin package repository is current, skipping spack repo update]")
+        else:
+            spack_repo_update_cmd = "repo update"
+            res = self.spack_sexe(spack_repo_update_cmd, echo=True)
+            if res != 0:
+                print("[ERROR: Failed to update git reference for builtin package repository]")
+                sys.exit(-1)
+
+        self.update_spack_env(previous, inputs)
+
+        save_state(self.spack_env_inputs_file(), inputs)
+
+    def new_spack_env(self):
         # Create Spack Environment
         print("[creating spack env]")
         if self.spack_env_file is None:
             self.spack_env_file = ""
-        spack_create_cmd = "{0} env create -d {1} {2}".format(self.spack_exe(use_spack_env=False),
-            self.spack_env_directory, self.spack_env_file)
-        res = sexe(spack_create_cmd, echo=True)
+        spack_create_cmd = "env create -d {0} {1}".format(self.spack_env_directory, self.spack_env_file)
+        res = self.spack_sexe(spack_create_cmd, use_spack_env=False, echo=True)
         if res != 0:
             print("[ERROR: Failed to create Spack Environment]")
             sys.exit(-1)
 
-        spack_pkg_keys = ("spack_packages_commit", "spack_packages_branch", "spack_packages_tag")
-        if any(key in self.project_args for key in spack_pkg_keys):
-            # Check if environment specifies alternate builtin packages repository
-            print("[checking for alternate builtin repository in environment...]")
-            res, out = sexe(f"{self.spack_exe()} config --scope env:{self.spack_env_file} get repos", ret_output=True)
-            if res == 0 and "builtin" in out:
-                print("[WARNING: Environment specifies alternate builtin packages repository, it will take precedence over any setting in uberenv config file.]")
-                print(f"[Environment builtin repo config: {out.strip()}]")
-
-        spack_repo_update_cmd = f"{self.spack_exe()} repo update"
-        res = sexe(spack_repo_update_cmd, echo=True)
-        if res != 0:
-            print("[ERROR: Failed to update git reference for builtin package repository]")
-            sys.exit(-1)
+        # checked when the manifest is edited
+        self.check_env_builtin_repo = True
 
         # Find pre-installed compilers and packages and stop uberenv.py
         if self.spack_setup_environment:
-            # Finding compilers
-            print("[finding compilers]")
-            if self.spack_compiler_paths is None:
-                spack_compiler_find_cmd = "{0} compiler find".format(self.spack_exe())
+            generated_spack_yaml = pjoin(self.spack_env_directory, "spack.yaml")
+            cached_spack_yaml = self.discovery_cache_entry()
+            if cached_spack_yaml is not None and os.path.isfile(cached_spack_yaml):
+                # the environment was created empty, so its spack.yaml only
+                # differs in what the discovery below adds
+                print("[using compilers and packages found before: {0}]".format(cached_spack_yaml))
+                shutil.copyfile(cached_spack_yaml, generated_spack_yaml)
             else:
-                spack_compiler_find_cmd = "{0} compiler find {1}".format(self.spack_exe(), self.spack_compiler_paths)
-            res_compiler = sexe(spack_compiler_find_cmd, echo=True)
-            if res_compiler != 0:
-                print("[ERROR: Failed to setup Spack Environment]")
-                sys.exit(-1)
+                self.find_compilers_and_externals()
+                if cached_spack_yaml is not None:
+                    print("[adding found compilers and packages to discovery cache {0}]".format(cached_spack_yaml))
+                    tmp = "{0}.tmp.{1}".format(cached_spack_yaml, os.getpid())
+                    shutil.copyfile(generated_spack_yaml, tmp)
+                    os.replace(tmp, cached_spack_yaml)
+
+            # Copy spack.yaml to where you called package source dir
+            copied_spack_yaml = pjoin(pabs(self.pkg_src_dir), "spack.yaml")
+            print("[copying spack yaml file to {0}]".format(copied_spack_yaml))
+            sexe("cp {0} {1}".format(generated_spack_yaml, copied_spack_yaml))
 
-            # Finding externals
-            spack_external_find_cmd = "{0} external find --not-buildable".format(self.spack_exe())
+            print("[setup environment]")
+
+    def find_compilers_and_externals(self):
+        # Finding compilers
+        print("[finding compilers]")
+        if self.spack_compiler_paths is None:
+            spack_compiler_find_cmd = "compiler find"
+        else:
+            spack_compiler_find_cmd = "compiler find {0}".format(self.spack_compiler_paths)
+        res_compiler = self.spack_sexe(spack_compiler_find_cmd, echo=True)
+        if res_compiler != 0:
+            print("[ERROR: Failed to setup Spack Environment]")
+            sys.exit(-1)
+
+        # Finding externals
+        self.find_externals()
+
+    def detectable_packages(self):
+        """
+        Names of the packages `spack external find --all` looks for, from
+        `spack external list`. None if this spack does not have it.
+        """
+        res, out = self.spack_sexe("external list", ret_output=True)
+        if res != 0:
+            return None
+        names = set()
+        for line in out.splitlines():
+            line = line.strip()
+            if not line or line.startswith(("==>", "Repository")):
+                continue
+            names.update(line.split())
+        return sorted(names) or None
+
+    def find_externals(self):
+        """
+        Runs `spack external find --not-buildable` for the spack_externals
+        list, or all detectable packages, split into shards that run
+        concurrently (up to uberenv_jobs()), each in a scratch copy of the
+        environment. What they found is merged into the environment in one
+        spack python call.
+        """
+        spack_external_find_cmd = "external find --not-buildable"
+        if self.spack_externals is None:
+            print("[finding all packages Spack knows about]")
+            names = self.detectable_packages()
+        else:
+            print("[finding packages from list]")
+            names = self.spack_externals.split()
+
+        jobs = self.uberenv_jobs()
+        if names is None or jobs < 2 or len(names) < 2:
             if self.spack_externals is None:
-                print("[finding all packages Spack knows about]")
                 spack_external_find_cmd = "{0} --all".format(spack_external_find_cmd)
             else:
-                print("[finding packages from list]")
                 spack_external_find_cmd = "{0} {1}".format(spack_external_find_cmd, self.spack_externals)
-            res_external = sexe(spack_external_find_cmd, echo=True)
+            res_external = self.spack_sexe(spack_external_find_cmd, echo=True)
             if res_external != 0:
                 print("[ERROR: Failed to setup Spack Environment]")
                 sys.exit(-1)
+            return
 
-            # Copy spack.yaml to where you called package source dir
-            generated_spack_yaml = pjoin(self.spack_env_directory, "spack.yaml")
-            copied_spack_yaml = pjoin(pabs(self.pkg_src_dir), "spack.yaml")
-            print("[copying spack yaml file to {0}]".format(copied_spack_yaml))
-            sexe("cp {0} {1}".format(generated_spack_yaml, copied_spack_yaml))
+        shards = split_shards(names, jobs)
+        scratch = pjoin(self.dest_dir, ".uberenv_external_find")
+        if os.path.isdir(scratch):
+            shutil.rmtree(scratch)
+        shard_dirs = []
+        commands = []
+        for i, shard in enumerate(shards):
+            shard_dir = pjoin(scratch, "shard{0}".format(i))
+            os.makedirs(shard_dir)
+            shutil.copyfile(pjoin(self.spack_env_directory, "spack.yaml"), pjoin(shard_dir, "spack.yaml"))
+            shard_dirs.append(shard_dir)
+            commands.append(self.spack_command("-D {0} {1} {2}".format(shard_dir, spack_external_find_cmd,
+                                                                        " ".join(shard)),
+                                               use_spack_env=False, ret_output=True))
+        print("[finding {0} packages in {1} shards]".format(len(names), len(shards)))
+        def shard_done(i, result):
+            res, out = result
+            print("[shard {0} of {1} finished with {2} packages]".format(i + 1, len(shards), len(shards[i])))
+            print(out, end="")
+        results = self.run_commands(commands, done=shard_done)
+        if any(res != 0 for res, out in results):
+            print("[ERROR: Failed to setup Spack Environment]")
+            sys.exit(-1)
 
-            print("[setup environment]")
+        request = {"env_dir": self.spack_env_directory, "shards": shard_dirs}
+        script = "import json\nrequest = json.loads({0!r})\n{1}".format(json.dumps(request),
+                                                                    SPACK_EXTERNALS_MERGER)
+        res, out = self.spack_sexe("python -c {0}".format(shlex.quote(script)),
+                                   use_spack_env=False, ret_output=True)
+        found = None
+        for line in out.splitlines():
+            if line.startswith("[uberenv externals: "):
+                found = json.loads(line[len("[uberenv externals: "):-1])
+            else:
+                print(line)
+        if res != 0 or found is None:
+            print("[ERROR: Failed to merge found packages into Spack Environment]")
+            sys.exit(-1)
+        print("[added {0} packages found in {1} shards to spack env]".format(len(found), len(shards)))
+        shutil.rmtree(scratch)
 
-        # For each package path (if there is a repo.yaml), add Spack repository to environment
-        if len(self.packages_paths) > 0:
-            for _base_path in self.packages_paths:
-                spack_pkg_repo      = os.path.join(_base_path, "../")
-                spack_pkg_repo_yaml = os.path.join(_base_path, "../repo.yaml")
-                if os.path.isfile(os.path.join(spack_pkg_repo_yaml)):
-                    print("[adding spack repo {0}]".format(spack_pkg_repo))
-                    spack_repo_add_cmd = "{0} repo add {1}".format(self.spack_exe(), spack_pkg_repo)
-                    sexe(spack_repo_add_cmd, echo=True)
-                else:
-                    print("[ERROR: No Spack repo.yaml detected in {0}]".format(spack_pkg_repo))
-                    sys.exit(-1)
+    def discovery_cache_entry(self):
+        """
+        The discovery cache file for the current toolchain, or None without
+        a discovery cache. It is named by a hash of the spack and builtin
+        packages commits, the compiler paths and externals lists, the
+        DISCOVERY_ENV_VARS and the compilers and externals PATH and the
+        compiler paths resolve to.
+        """
+        if self.discovery_cache_path is None:
+            return None
+        if not os.path.isdir(self.discovery_cache_path):
+            os.makedirs(self.discovery_cache_path)
+        dirs = os.environ.get("PATH", "").split(os.pathsep)
+        for path in (self.spack_compiler_paths or "").split():
+            dirs += [path, pjoin(path, "bin")]
+        h = hashlib.sha256()
+        h.update("spack: {0}\n".format(read_git_head(self.dest_spack)).encode("utf8"))
+        h.update("builtin: {0}\n".format(read_git_head(self.builtin_packages_repo_path())).encode("utf8"))
+        h.update("compilers: {0}\nexternals: {1}\n".format(self.spack_compiler_paths,
+                                                          self.spack_externals).encode("utf8"))
+        for var in DISCOVERY_ENV_VARS:
+            h.update("{0}={1}\n".format(var, os.environ.get(var, "")).encode("utf8"))
+        names = list(DISCOVERY_EXECUTABLES) + (self.spack_externals or "").split()
+        h.update(executables_fingerprint(names, dirs).encode("utf8"))
+        h.update(host_fingerprint().encode("utf8"))
+        return pjoin(self.discovery_cache_path, "{0}.yaml".format(h.hexdigest()))
+
+    def update_spack_env(self, previous, inputs):
+        """
+        Brings the repos, spec, develop, mirror and upstream settings of the
+        environment from what it was built with (previous) to inputs, by
+        editing its spack.yaml directly in a single spack python call.
+        """
+        for spack_pkg_repo in inputs["repos"]:
+            if not os.path.isfile(pjoin(spack_pkg_repo, "repo.yaml")):
+                print("[ERROR: No Spack repo.yaml detected in {0}]".format(spack_pkg_repo))
+                sys.exit(-1)
 
-        # Add spack package
-        print("[adding spack package]")
-        spack_add_cmd = "{0} add {1}".format(self.spack_exe(),
-            self.pkg_name_with_spec)
-        res = sexe(spack_add_cmd, echo=True)
-        if res != 0:
-            print(f"[ERROR: Failed to add Spack spec '{self.pkg_name_with_spec}']")
+        changes = [key for key in ("repos", "spec", "develop", "mirror", "upstream")
+                   if previous[key] != inputs[key]]
+        if not changes and not self.check_env_builtin_repo:
+            return
+
+        request = {"env_dir": self.spack_env_directory,
+                   "remove_repos": previous["repos"],
+                   "add_repos": inputs["repos"],
+                   "remove_spec": previous["spec"],
+                   "add_spec": inputs["spec"],
+                   "remove_develop": previous["develop"][0] if previous["develop"] else None,
+                   "add_develop": inputs["develop"],
+                   "remove_mirror": previous["mirror"],
+                   "add_mirror": inputs["mirror"],
+                   "remove_upstream": previous["upstream"],
+                   "add_upstream": inputs["upstream"]}
+        for spack_pkg_repo in inputs["repos"]:
+            print("[adding spack repo {0}]".format(spack_pkg_repo))
+        if inputs["spec"] is not None:
+            print("[adding spack package {0}]".format(inputs["spec"]))
+        if inputs["develop"] is not None:
+            print("[developing {0} from {1}]".format(inputs["develop"][1], inputs["develop"][2]))
+        if inputs["mirror"] is not None:
+            print("[using mirror {0}]".format(inputs["mirror"][1]))
+        if inputs["upstream"] is not None:
+            print("[using upstream {0}]".format(inputs["upstream"][1]))
+
+        print("[updating spack env manifest {0}]".format(pjoin(self.spack_env_directory, "spack.yaml")))
+        script = "import json\nrequest = json.loads({0!r})\n{1}".format(json.dumps(request),
+                                                                    SPACK_MANIFEST_EDITOR)
+        res, out = self.spack_sexe("python -c {0}".format(shlex.quote(script)),
+                                   use_spack_env=False, ret_output=True)
+        result = None
+        for line in out.splitlines():
+            if line.startswith("[uberenv manifest: "):
+                result = json.loads(line[len("[uberenv manifest: "):-1])
+            else:
+                print(line)
+        if res != 0 or result is None:
+            print("[ERROR: Failed to update Spack Environment manifest]")
             sys.exit(-1)
 
-        # For dev-build, call develop
-        if self.build_mode == "dev-build":
-            print("[calling spack develop]")
-            spack_develop_cmd = "{0} develop --no-clone --path={1} {2}@={3}".format(
-                self.spack_exe(), self.pkg_src_dir, self.pkg_name, self.pkg_version)
-            sexe(spack_develop_cmd, echo=True)
+        spack_pkg_keys = ("spack_packages_commit", "spack_packages_branch", "spack_packages_tag")
+        if self.check_env_builtin_repo and result["builtin_repo"] and \
+           any(key in self.project_args for key in spack_pkg_keys):
+            print("[WARNING: Environment specifies alternate builtin packages repository, it will take precedence over any setting in uberenv config file.]")
+        self.check_env_builtin_repo = False
+
+    def concretization_cache(self):
+        if self.concretize_cache_path is None:
+            return None
+        # a --reuse solve depends on what is already installed
+        if "--fresh" not in self.add_concretizer_args(""):
+            print("[info: concretization cache is only used for --fresh concretization]")
+            return None
+        max_size = self.set_from_args_or_json("concretize_cache_size")
+        if max_size is None:
+            max_size = 1024
+        return ConcretizationCache(self.concretize_cache_path, max_size * 1024 * 1024)
+
+    def builtin_packages_repo_path(self):
+        # newer spack keeps its builtin packages outside of the spack repo
+        if os.path.exists(pjoin(self.dest_spack, "var", "spack", "repos", "builtin")):
+            return pjoin(self.dest_spack, "var", "spack", "repos", "builtin")
+        return pjoin(self.dest_dir, "builtin_spack_packages_repo")
+
+    def spack_config_scope_files(self):
+        """
+        The config files of all scopes spack reads in the Spack Environment
+        (including the files and directories it includes, and the user and
+        site scopes when they are enabled), in order, or None if spack can
+        not tell.
+        """
+        res, out = self.spack_sexe("python -c {0}".format(shlex.quote(SPACK_CONFIG_SCOPES)),
+                                   ret_output=True)
+        paths = None
+        for line in out.splitlines():
+            if line.startswith("[uberenv config scopes: "):
+                paths = json.loads(line[len("[uberenv config scopes: "):-1])
+        if res != 0 or paths is None:
+            return None
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                # a directory scope reads <section>.yaml, platform
+                # subdirectories are scopes of their own
+                files += sorted(glob.glob(pjoin(path, "*.yaml")))
+            else:
+                files.append(path)
+        return files
+
+    def concretization_cache_key(self):
+        """
+        Hash of every input of the concretizer: the environment files,
+        config files of all scopes, package repos, spack and spack-packages
+        commits, the spec, and the host spack detects the default target
+        from. Files in the prefix are named relative to it, so that other
+        prefixes find the same entries. None if the config scopes are
+        unknown.
+        """
+        config_files = self.spack_config_scope_files()
+        if config_files is None:
+            return None
+        def prefix_name(path):
+            name = os.path.relpath(path, self.dest_dir)
+            return path if name.startswith(os.pardir) else name
+        h = hashlib.sha256()
+        if self.spack_env_file:
+            hash_file(h, self.spack_env_file)
+        # the environment as uberenv set it up (repos, specs, develop, ...)
+        env_yaml = pjoin(self.spack_env_directory, "spack.yaml")
+        hash_file(h, env_yaml, name=prefix_name(env_yaml))
+        # and the scopes spack reads in it (defaults, site, user, includes)
+        for config_file in config_files:
+            hash_file(h, config_file, name=prefix_name(config_file))
+        for config_file in ("defaults.yaml", "versions.yaml"):
+            hash_file(h, pjoin(self.spack_configs_path, config_file))
+        for packages_path in self.packages_paths:
+            hash_tree(h, packages_path)
+        h.update(str(read_git_head(self.dest_spack)).encode("utf8"))
+        h.update(str(read_git_head(self.builtin_packages_repo_path())).encode("utf8"))
+        h.update(self.args["spec"].encode("utf8"))
+        h.update(self.add_concretizer_args("").encode("utf8"))
+        h.update(host_fingerprint().encode("utf8"))
+        return h.hexdigest()
 
     def concretize_spack_env(self):
+        if self.args["import_bundle"] is not None:
+            print("[using the concretization of bundle {0} as it is]".format(self.args["import_bundle"]))
+            return 0
+
+        cache = self.concretization_cache()
+        spack_lock = pjoin(self.spack_env_directory, "spack.lock")
+        if cache is not None:
+            cache_key = self.concretization_cache_key()
+            if cache_key is None:
+                print("[WARNING: Could not list spack's config scopes, not using the concretization cache]")
+                cache = None
+            elif cache.restore(cache_key, spack_lock):
+                print("[using cached concretization {0} from {1}]".format(cache_key, cache.path))
+                return 0
+
         # Spack concretize
         print("[concretizing spack env]")
-        spack_concretize_cmd = "{0} concretize ".format(self.spack_exe())
+        spack_concretize_cmd = "concretize "
         spack_concretize_cmd = self.add_concretizer_args(spack_concretize_cmd)
-        sexe(spack_concretize_cmd, echo=True)
+        missing = set()
+        def find_missing_package(line):
+            for pattern in (r"[Pp]ackage '([A-Za-z0-9_\-]+)' not found",
+                            r"[Uu]nknown package:? '?([A-Za-z0-9_\-]+)",
+                            r"no package named '?([A-Za-z0-9_\-]+)"):
+                missing.update(re.findall(pattern, line))
+        sparse = self.args["spack_packages_sparse"] and self.builtin_repo_is_sparse()
+        res = self.spack_sexe(spack_concretize_cmd, echo=True,
+                              parsers=[find_missing_package] if sparse else ())
+        # a sparse builtin repo grows until everything concretizes, when
+        # nothing can be added (e.g. an unknown virtual or compiler) the
+        # full repo is checked out instead
+        while sparse and res != 0:
+            added = 0
+            if missing:
+                print("[adding missing packages to builtin package repository: {0}]".format(" ".join(sorted(missing))))
+                added = self.sparse_packages_add(missing)
+            if added == 0:
+                print("[info: checking out the full builtin package repository]")
+                res = sexe("git -C {0} sparse-checkout disable".format(self.builtin_packages_repo_path()), echo=True)
+                if res != 0:
+                    print("[ERROR: Failed to check out the full builtin package repository]")
+                    sys.exit(-1)
+                sparse = False
+            missing.clear()
+            res = self.spack_sexe(spack_concretize_cmd, echo=True,
+                                  parsers=[find_missing_package] if sparse else ())
+
+        if cache is not None and res == 0 and os.path.isfile(spack_lock):
+            print("[adding concretization {0} to cache {1}]".format(cache_key, cache.path))
+            cache.store(cache_key, spack_lock)
+        return res
+
+    # Spack caches and what they depend on, see clean_build_inputs()
+    clean_build_caches = (("misc-cache", ("spack", "builtin", "packages")),
+                          ("python-cache", ("spack", "builtin")))
+
+    def clean_build_inputs(self):
+        """
+        The inputs of spack's caches: spack commit, builtin packages repo
+        ref and the contents of the spack_packages_path repos.
+        """
+        h = hashlib.sha256()
+        for packages_path in self.packages_paths:
+            hash_tree(h, packages_path)
+        return {"spack": str(read_git_head(self.dest_spack)),
+                "builtin": str(read_git_head(self.builtin_packages_repo_path())),
+                "packages": h.hexdigest()}
 
     def clean_build(self):
-        # clean out any spack cached stuff (except build stages, downloads, &
-        # spack's bootstrapping software)
-        cln_cmd = "{0} clean --misc-cache --failures --python-cache".format(self.spack_exe(use_spack_env=False))
-        res = sexe(cln_cmd, echo=True)
+        # clean out spack cached stuff (except build stages, downloads, &
+        # spack's bootstrapping software). Caches are only cleaned when
+        # their inputs changed since the last clean (or with --clean-caches),
+        # previous install failures are always cleared.
+        inputs = self.clean_build_inputs()
+        inputs_file = pjoin(self.dest_dir, ".uberenv_clean_build.json")
+        previous = {}
+        if not self.args["clean_caches"]:
+            previous = load_state(inputs_file) or {}
+
+        cln_cmd = "clean --failures"
+        for cache, cache_inputs in self.clean_build_caches:
+            changed = [key for key in cache_inputs if previous.get(key) != inputs[key]]
+            if cache == "python-cache" and self.spack_root is not None:
+                # would remove bytecode from the read-only spack checkout
+                print("[keeping spack {0}, spack_root is read-only]".format(cache))
+            elif changed:
+                cln_cmd += " --{0}".format(cache)
+            else:
+                print("[keeping spack {0}, its inputs are unchanged]".format(cache))
+        res = self.spack_sexe(cln_cmd, use_spack_env=False, echo=True)
+        if res == 0:
+            save_state(inputs_file, inputs)
+        else:
+            remove_state(inputs_file)
 
         # check if we need to force uninstall of selected packages
         if self.args["spack_clean"]:
             if "spack_clean_packages" in self.project_args:
                 for cln_pkg in self.project_args["spack_clean_packages"]:
                     if self.find_spack_pkg_path(cln_pkg) is not None:
-                        unist_cmd = "{0} uninstall -f -y --all --dependents ".format(self.spack_exe()) + cln_pkg
-                        res = sexe(unist_cmd, echo=True)
+                        unist_cmd = "uninstall -f -y --all --dependents " + cln_pkg
+                        res = self.spack_sexe(unist_cmd, echo=True)
 
     def show_info(self):
         # print version of spack
@@ -1078,27 +3741,32 @@ class SpackEnv(UberEnv):
         options = ""
         options = self.add_concretizer_args(options)
         options += "--install-status --very-long"
-        spec_cmd = "{0} spec {1}".format(self.spack_exe(), options)
+        spec_cmd = "spec {0}".format(options)
 
-        res, out = sexe(spec_cmd, ret_output=True, echo=True)
-        print(out)
-
-        # Check if spec is already installed and set spec_hash
-        for line in out.split("\n"):
+        # Check if spec is already installed and set spec_hash, while the
+        # spec is printed
+        spec_line = re.compile(r"^(\[\+\]| - )  [a-z0-9]{32}  " + re.escape(self.pkg_name))
+        installed = []
+        def find_spec_hash(line):
             # Example of matching line: ("status"  "hash"  "package"...)
             # [+]  hf3cubkgl74ryc3qwen73kl4yfh2ijgd  serac@develop%clang@10.0.0-apple~debug~devtools~glvis arch=darwin-mojave-x86_64
-            if re.match(r"^(\[\+\]| - )  [a-z0-9]{32}  " + re.escape(self.pkg_name), line):
+            if spec_line.match(line):
                 self.spec_hash = line.split("  ")[1].lstrip()
-                # if spec already installed
                 if line.startswith("[+]"):
-                    pkg_path = self.find_spack_pkg_path_from_hash(self.pkg_name,self.spec_hash)
-                    install_path = pkg_path["path"]
-                    # testing that the path exists is mandatory until Spack team fixes
-                    # https://github.com/spack/spack/issues/16329
-                    if os.path.isdir(install_path):
-                        print("[Warning: {0} has already been installed in {1}]".format(self.pkg_name_with_spec,install_path))
-                        print("[Warning: Uberenv will proceed using this directory]")
-                        self.use_install = True
+                    installed.append(self.spec_hash)
+
+        res = self.spack_sexe(spec_cmd, echo=True, parsers=[find_spec_hash])
+
+        # if spec already installed
+        for spec_hash in installed:
+            pkg_path = self.find_spack_pkg_path_from_hash(self.pkg_name,spec_hash)
+            install_path = pkg_path["path"]
+            # testing that the path exists is mandatory until Spack team fixes
+            # https://github.com/spack/spack/issues/16329
+            if os.path.isdir(install_path):
+                print("[Warning: {0} has already been installed in {1}]".format(self.pkg_name_with_spec,install_path))
+                print("[Warning: Uberenv will proceed using this directory]")
+                self.use_install = True
 
         return res
 
@@ -1108,7 +3776,7 @@ class SpackEnv(UberEnv):
         # and build an host-config.cmake file
         if not self.use_install:
             # create install command using appropriate flags
-            install_cmd = self.spack_exe() + " "
+            install_cmd = ""
 
             # spack flags
             if self.args["ignore_ssl_errors"]:
@@ -1128,7 +3796,7 @@ class SpackEnv(UberEnv):
             if self.args["build_jobs"]:
                 install_cmd += "-j {0} ".format(self.args["build_jobs"])
 
-            res = sexe(install_cmd, echo=True)
+            res = self.spack_sexe(install_cmd, echo=True)
             if res != 0:
                 print("[ERROR: Failure of spack install]")
                 return res
@@ -1158,6 +3826,8 @@ class SpackEnv(UberEnv):
                             sexe("rm -f {0}".format(hc_symlink_path))
                         print("[symlinking host config file {0} to {1}]".format(hc_path,hc_symlink_path))
                         os.symlink(hc_path,hc_symlink_path)
+                        self.host_config_path = hc_symlink_path
+                        self.install_prefix = pkg_path["path"]
                     # if user opt'd for an install, we want to symlink the final
                     # install to an easy place:
                     # Symlink install directory
@@ -1185,12 +3855,229 @@ class SpackEnv(UberEnv):
                     os.unlink(hc_fname)
                 print("[copying host config file to {0}]".format(pjoin(self.dest_dir,hc_fname)))
                 sexe("cp {0} {1}".format(hc_path,hc_fname))
+                self.host_config_path = pabs(hc_fname)
                 print("[removing project build directory {0}]".format(pjoin(build_dir)))
                 sexe("rm -rf {0}".format(build_dir))
+                # the host-config points at the installed dependencies
+                self.tpl_prefixes = self.find_spack_env_prefixes()
         else:
             print("[ERROR: Unsupported build mode: {0}]".format(self.build_mode))
             return -1
 
+        self.write_install_manifest()
+
+    # Settings that change what gets installed
+    install_manifest_args = ("spec", "install", "spack_build_mode", "package_name",
+                             "package_final_phase", "package_source_dir", "run_tests",
+                             "reuse", "spack_allow_deprecated", "spack_env_file",
+                             "spack_externals", "spack_compiler_paths", "upstream")
+
+    def install_manifest_file(self):
+        return pjoin(self.dest_dir, ".uberenv_install_manifest.json")
+
+    def install_inputs_hash(self, include_checkouts=True):
+        """
+        Hash of everything that determines what uberenv installs. Only reads
+        files, so it can be checked before spack is touched.
+        """
+        h = hashlib.sha256()
+        hash_file(h, self.project_json)
+        for key in self.install_manifest_args:
+            h.update("{0}={1}\n".format(key, self.args.get(key)).encode("utf8"))
+        if self.spack_env_file:
+            hash_file(h, self.spack_env_file)
+        for config_file in ("defaults.yaml", "versions.yaml"):
+            hash_file(h, pjoin(self.spack_configs_path, config_file))
+        for packages_path in self.packages_paths:
+            hash_tree(h, packages_path)
+        if include_checkouts:
+            h.update(str(read_git_head(self.dest_spack)).encode("utf8"))
+            h.update(str(read_git_head(self.builtin_packages_repo_path())).encode("utf8"))
+        return h.hexdigest()
+
+    def setup_inputs_hash(self):
+        """
+        Hash of what the prepared spack checkout depends on: the project
+        settings that pin spack and spack-packages.
+        """
+        h = hashlib.sha256()
+        for key in sorted(self.project_args.keys()):
+            if key.startswith("spack_") and key not in ("spack_build_mode", "spack_externals",
+                                                        "spack_compiler_paths",
+                                                        "spack_configs_path",
+                                                        "spack_packages_path"):
+                h.update("{0}={1}\n".format(key, self.project_args[key]).encode("utf8"))
+        h.update("k={0}\n".format(self.args["ignore_ssl_errors"]).encode("utf8"))
+        h.update("root={0}\n".format(self.spack_root).encode("utf8"))
+        return h.hexdigest()
+
+    def phase_inputs_hash(self):
+        # The checkouts are left out, they are outputs of clone_repo and
+        # the project json already pins them
+        h = hashlib.sha256()
+        h.update(self.install_inputs_hash(include_checkouts=False).encode("utf8"))
+        h.update("mirror={0}".format(self.args["mirror"]).encode("utf8"))
+        return h.hexdigest()
+
+    def write_install_manifest(self):
+        if self.host_config_path is None:
+            # nothing a later run could check for
+            return
+        manifest = {"inputs": self.install_inputs_hash(),
+                    "spec_hash": self.spec_hash,
+                    "host_config": self.host_config_path,
+                    "install_prefix": self.install_prefix,
+                    "tpl_prefixes": self.tpl_prefixes}
+        save_state(self.install_manifest_file(), manifest)
+
+    def install_is_current(self):
+        manifest = load_state(self.install_manifest_file())
+        if manifest is None:
+            return False
+        if manifest.get("inputs") != self.install_inputs_hash():
+            print("[info: inputs changed since the last install]")
+            return False
+        # os.path.exists follows the host-config symlink to the install
+        if not os.path.exists(manifest["host_config"]):
+            print("[info: host-config {0} is missing]".format(manifest["host_config"]))
+            return False
+        if manifest["install_prefix"] is not None and not os.path.isdir(manifest["install_prefix"]):
+            print("[info: install prefix {0} is missing]".format(manifest["install_prefix"]))
+            return False
+        for prefix in manifest.get("tpl_prefixes", []):
+            if not os.path.isdir(prefix):
+                print("[info: dependency install prefix {0} is missing]".format(prefix))
+                return False
+        print("[{0} with hash {1} is already installed and its host-config {2} is current]".format(
+              self.pkg_name, manifest["spec_hash"], manifest["host_config"]))
+        print("[Nothing to do, use --force to run all steps anyway]")
+        return True
+
+    def export_git_commit(self, repo_dir, dest):
+        """
+        Writes a bare git repo with only the checked out commit of repo_dir
+        to dest, returns the commit.
+        """
+        sha1 = read_git_head(repo_dir)
+        if sha1 is None:
+            res, sha1 = sexe("git -C {0} rev-parse HEAD".format(repo_dir), ret_output=True)
+            sha1 = sha1.strip()
+        print("[adding commit {0} of {1} to bundle]".format(sha1, repo_dir))
+        res = sexe("git init -q --bare {0}".format(dest), echo=True)
+        if res == 0:
+            res = sexe("git -C {0} fetch -q --depth=1 {1} {2}".format(dest, repo_dir, sha1), echo=True)
+        if res == 0:
+            # (fetching a commit needs a ref that reaches it)
+            res = sexe("git -C {0} update-ref refs/heads/uberenv-bundle {1}".format(dest, sha1), echo=True)
+        if res != 0:
+            print("[ERROR: Failed to add {0} to bundle]".format(repo_dir))
+            sys.exit(-1)
+        return sha1
+
+    def export_bundle(self):
+        """
+        Writes everything a run needs without network access to one archive:
+        the spack and spack-packages commits, a spack bootstrap mirror, a
+        source mirror of the concretized environment and its spack.lock.
+        See import_bundle().
+        """
+        bundle = self.args["export_bundle"]
+        staging = pjoin(self.dest_dir, "uberenv_bundle_export")
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+
+        info = {"spack_commit": self.export_git_commit(self.dest_spack, pjoin(staging, "spack"))}
+        packages_repo = self.builtin_packages_repo_path()
+        if not os.path.isdir(packages_repo):
+            print("[WARNING: No builtin package repository at {0}, it is not bundled]".format(packages_repo))
+        elif not packages_repo.startswith(self.dest_spack + os.sep):
+            if self.args["spack_packages_sparse"]:
+                print("[ERROR: A sparse builtin package repository can not be bundled, run without --spack-packages-sparse]")
+                sys.exit(-1)
+            info["spack_packages_commit"] = self.export_git_commit(packages_repo,
+                                                                   pjoin(staging, "spack-packages"))
+
+        if self.use_clingo_setup():
+            bootstrap_cmd = "bootstrap mirror --binary-packages {0}".format(pjoin(staging, "bootstrap_mirror"))
+            res = self.spack_sexe(bootstrap_cmd, use_spack_env=False, echo=True)
+            if res != 0:
+                print("[ERROR: Failed to create spack bootstrap mirror for bundle]")
+                sys.exit(-1)
+
+        # sources of every spec in the concretized environment
+        mirror_cmd = ""
+        if self.args["ignore_ssl_errors"]:
+            mirror_cmd += "-k "
+        mirror_cmd += "mirror create --all -d {0}".format(pjoin(staging, "mirror"))
+        res = self.spack_sexe(mirror_cmd, echo=True)
+        if res != 0:
+            print("[ERROR: Failed to create spack source mirror for bundle]")
+            sys.exit(-1)
+
+        shutil.copyfile(pjoin(self.spack_env_directory, "spack.lock"), pjoin(staging, "spack.lock"))
+        with open(pjoin(staging, "bundle.json"), "w") as f:
+            json.dump(info, f, indent=2)
+
+        print("[writing bundle {0}]".format(bundle))
+        tmp = "{0}.tmp.{1}".format(bundle, os.getpid())
+        with tarfile.open(tmp, "w:gz", compresslevel=6) as tar:
+            for member in sorted(os.listdir(staging)):
+                tar.add(pjoin(staging, member), arcname=member)
+        os.replace(tmp, bundle)
+        shutil.rmtree(staging)
+        return 0
+
+    def import_bundle(self):
+        """
+        Extracts a bundle written by export_bundle() into the prefix (once
+        per bundle file), and replaces the project's spack and spack-packages
+        urls and pins, the bootstrap mirror, the mirror and the Spack
+        Environment file with its contents.
+        """
+        bundle = self.args["import_bundle"]
+        if not os.path.isfile(bundle):
+            print("[ERROR: Bundle {0} does not exist]".format(bundle))
+            sys.exit(-1)
+        bundle_dir = pjoin(self.dest_dir, "uberenv_bundle")
+        st = os.stat(bundle)
+        source = {"bundle": bundle, "size": st.st_size, "mtime": st.st_mtime}
+        source_file = pjoin(bundle_dir, ".uberenv_bundle_source.json")
+        info_file = pjoin(bundle_dir, "bundle.json")
+        info = None
+        if load_state(source_file) == source:
+            info = load_state(info_file)
+        if info is not None:
+            print("[info: bundle {0} is already extracted to {1}]".format(bundle, bundle_dir))
+        else:
+            print("[extracting bundle {0} to {1}]".format(bundle, bundle_dir))
+            if os.path.isdir(bundle_dir):
+                shutil.rmtree(bundle_dir)
+            tmp = "{0}.tmp.{1}".format(bundle_dir, os.getpid())
+            extract = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+            with tarfile.open(bundle) as tar:
+                tar.extractall(tmp, **extract)
+            save_state(pjoin(tmp, ".uberenv_bundle_source.json"), source)
+            os.replace(tmp, bundle_dir)
+            info = load_state(info_file)
+        if info is None or "spack_commit" not in info:
+            print("[ERROR: Bundle {0} has no valid bundle.json]".format(bundle))
+            sys.exit(-1)
+        # spack and spack-packages are fetched from the bundle's git repos
+        self.project_args.pop("spack_branch", None)
+        self.project_args["spack_url"] = "file://" + pjoin(bundle_dir, "spack")
+        self.project_args["spack_commit"] = info["spack_commit"]
+        if "spack_packages_commit" in info:
+            self.project_args.pop("spack_packages_branch", None)
+            self.project_args.pop("spack_packages_tag", None)
+            self.project_args["spack_packages_url"] = "file://" + pjoin(bundle_dir, "spack-packages")
+            self.project_args["spack_packages_commit"] = info["spack_packages_commit"]
+        if os.path.isdir(pjoin(bundle_dir, "bootstrap_mirror")):
+            self.args["spack_bootstrap_mirror"] = pjoin(bundle_dir, "bootstrap_mirror")
+        self.args["mirror"] = pjoin(bundle_dir, "mirror")
+        self.args["spack_env_file"] = pjoin(bundle_dir, "spack.lock")
+        print("[info: using spack {0} and sources from bundle {1}]".format(info["spack_commit"], bundle))
+
     def get_mirror_path(self):
         mirror_path = self.args["mirror"]
         if not mirror_path:
@@ -1205,19 +4092,19 @@ class SpackEnv(UberEnv):
 
         mirror_path = self.get_mirror_path()
 
-        mirror_cmd = "{0} ".format(self.spack_exe())
+        mirror_cmd = ""
         if self.args["ignore_ssl_errors"]:
             mirror_cmd += "-k "
         mirror_cmd += "mirror create -d {0} --dependencies {1}".format(
             mirror_path, self.pkg_name_with_spec)
-        return sexe(mirror_cmd, echo=True)
+        return self.spack_sexe(mirror_cmd, echo=True)
 
     def find_spack_mirror(self, mirror_name):
         """
         Returns the path of a defaults scoped spack mirror with the
         given name, or None if no mirror exists.
         """
-        res, out = sexe("{0} mirror list".format(self.spack_exe()), ret_output=True)
+        res, out = self.spack_sexe("mirror list", ret_output=True)
         mirror_path = None
         for mirror in out.split('\n'):
             if mirror:
@@ -1242,13 +4129,13 @@ class SpackEnv(UberEnv):
             # Note: In this case, spack says it removes the mirror, but we still
             # get errors when we try to add a new one, sounds like a bug
             #
-            sexe("{0} mirror remove --scope=defaults {1} ".format(self.spack_exe(), mirror_name),
+            self.spack_sexe("mirror remove --scope={0} {1} ".format(self.spack_config_scope, mirror_name),
                 echo=True)
             existing_mirror_path = None
         if not existing_mirror_path:
             # Add if not already there
-            sexe("{0} mirror add --scope=defaults {1} {2}".format(
-                    self.spack_exe(), mirror_name, mirror_path), echo=True)
+            self.spack_sexe("mirror add --scope={0} {1} {2}".format(
+                    self.spack_config_scope, mirror_name, mirror_path), echo=True)
             print("[using mirror {0}]".format(mirror_path))
 
     def find_spack_upstream(self, upstream_name):
@@ -1258,7 +4145,7 @@ class SpackEnv(UberEnv):
         """
         upstream_path = None
 
-        res, out = sexe('{0} config get upstreams'.format(self.spack_exe()), ret_output=True)
+        res, out = self.spack_sexe("config get upstreams", ret_output=True)
         if (not out) and ("upstreams:" in out):
             out = out.replace(' ', '')
             out = out.replace('install_tree:', '')
@@ -1287,31 +4174,105 @@ class SpackEnv(UberEnv):
         if (not existing_upstream_path) or (upstream_path != pabs(existing_upstream_path)):
             # Existing upstream has different URL, error out
             print("[removing existing spack upstream configuration file]")
-            sexe("rm spack/etc/spack/defaults/upstreams.yaml")
-            with open('spack/etc/spack/defaults/upstreams.yaml','w+') as upstreams_cfg_file:
+            upstreams_yaml = pjoin(self.spack_config_scope_path(), "upstreams.yaml")
+            sexe("rm {0}".format(upstreams_yaml))
+            with open(upstreams_yaml,'w+') as upstreams_cfg_file:
                 upstreams_cfg_file.write("upstreams:\n")
                 upstreams_cfg_file.write("  {0}:\n".format(upstream_name))
                 upstreams_cfg_file.write("    install_tree: {0}\n".format(upstream_path))
 
+    def bootstrap_store_path(self):
+        root = self.spack_bootstrap_root
+        if root is None:
+            # spack's default: $user_cache_path/bootstrap
+            user_cache = os.environ.get("SPACK_USER_CACHE_PATH", pjoin("~", ".spack"))
+            root = pjoin(os.path.expanduser(user_cache), "bootstrap")
+        return pjoin(root, "store")
+
+    def bootstrap_state(self):
+        """
+        What a completed bootstrap depends on: spack commit, bootstrap
+        root and mirror, and the bootstrap config in spack's defaults scope
+        (lost when spack is cloned again). The config files are named by
+        their path in the scope, so a restored setup snapshot matches.
+        """
+        h = hashlib.sha256()
+        scope = self.spack_config_scope_path()
+        for config_file in sorted(glob.glob(pjoin(scope, "**", "bootstrap.yaml"), recursive=True)):
+            hash_file(h, config_file, name=os.path.relpath(config_file, scope))
+        return {"commit": read_git_head(self.dest_spack),
+                "root": self.spack_bootstrap_root,
+                "mirror": self.spack_bootstrap_mirror,
+                "config": h.hexdigest()}
+
+    def bootstrap_is_complete(self):
+        """
+        True if a previous run bootstrapped clingo with the same spack and
+        settings, and the bootstrap store is still there. Needs no spack call.
+        """
+        state_file = pjoin(self.dest_dir, ".uberenv_bootstrap.json")
+        if not os.path.isdir(self.bootstrap_store_path()):
+            return False
+        return load_state(state_file) == self.bootstrap_state()
+
+    def configure_bootstrap(self):
+        """
+        Points spack at the bootstrap root and local bootstrap mirror, in
+        the defaults config scope (the prefix's user scope with spack_root).
+        """
+        if self.spack_bootstrap_root is not None:
+            res = self.spack_sexe("bootstrap root --scope {0} {1}".format(self.spack_config_scope,
+                                                                         self.spack_bootstrap_root),
+                                  use_spack_env=False, echo=True)
+            if res != 0:
+                print("[ERROR: Failed to set spack bootstrap root to {0}]".format(self.spack_bootstrap_root))
+                sys.exit(-1)
+        if self.spack_bootstrap_mirror is not None:
+            for kind in ("sources", "binaries"):
+                name = "uberenv-local-{0}".format(kind)
+                metadata = pjoin(self.spack_bootstrap_mirror, "metadata", kind)
+                if not os.path.isdir(metadata):
+                    continue
+                # replaces the source added by a previous run, if any
+                self.spack_sexe("bootstrap remove {0}".format(name), use_spack_env=False, ret_output=True)
+                res = self.spack_sexe("bootstrap add --scope {0} --trust {1} {2}".format(self.spack_config_scope,
+                                                                                    name, metadata),
+                                      use_spack_env=False, echo=True)
+                if res != 0:
+                    print("[ERROR: Failed to add spack bootstrap mirror {0}]".format(metadata))
+                    sys.exit(-1)
+
     def setup_clingo(self):
         """
         Attempts to install the clingo answer set programming library via Spack
         if it is not already available as a Python module
         """
-        if not have_internet():
-            print("[WARNING: No internet detected. Skipping setting up clingo.]")
+        if self.bootstrap_is_complete():
+            print("[clingo is already bootstrapped in {0}]".format(self.bootstrap_store_path()))
             return
 
-        res = sexe('{0} bootstrap now'.format(self.spack_exe(use_spack_env = False)), echo=True)
+        state_file = pjoin(self.dest_dir, ".uberenv_bootstrap.json")
+        remove_state(state_file)
+
+        self.configure_bootstrap()
+
+        if self.spack_bootstrap_mirror is None and not self.check_internet():
+            print("[WARNING: No internet detected and no --spack-bootstrap-mirror given. Skipping setting up clingo, "
+                  "concretization will fail unless spack can find clingo already.]")
+            return Phase.INCOMPLETE
+
+        res = self.spack_sexe("bootstrap now", use_spack_env=False, echo=True)
         if res != 0:
             print("[ERROR: 'spack bootstrap now' failed with returncode {0}]".format(res))
             sys.exit(-1)
 
-        res = sexe('{0} bootstrap status'.format(self.spack_exe(use_spack_env = False)), echo=True)
+        res = self.spack_sexe("bootstrap status", use_spack_env=False, echo=True)
         if res != 0:
             print("[ERROR: 'spack bootstrap status' failed with returncode {0}]".format(res))
             sys.exit(-1)
 
+        save_state(state_file, self.bootstrap_state())
+
 
 def find_osx_sdks():
     """
@@ -1358,56 +4319,41 @@ def print_uberenv_python_info():
     print("[uberenv python: {0}]".format(sys.executable))
 
 
-def main():
+def uberenv_phases(env, args):
     """
-    Clones and runs a package manager to setup third_party libs.
-    Also creates a host-config.cmake file that can be used by our project.
+    Returns the phases needed for this invocation, and the name of the
+    phase whose return value is uberenv's return code.
     """
-
-    print_uberenv_python_info()
-
-    # parse args from command line
-    args, extra_args = parse_args()
-
-    # project options
-    args["project_json"] = find_project_config(args)
-
-    # Initialize the environment -- use vcpkg on windows, spack otherwise
-    env = SpackEnv(args, extra_args) if not is_windows() else VcpkgEnv(args, extra_args)
-
-    # Setup the necessary paths and directories
-    env.setup_paths_and_dirs()
-
-    # Go to package manager's destination
-    os.chdir(env.dest_dir)
+    phases = []
+    setup = []
 
     # Setup package manager
     if not args["skip_setup"] and not args["skip_setup_and_env"]:
-        # Clone the package manager
-        env.clone_repo()
-
-        # Patch the package manager, as necessary
-        env.patch()
-
-        # Clean the build
-        env.clean_build()
+        phases += env.setup_phases()
+        setup = ["setup"]
 
         # Allow to end uberenv after Spack is ready
         if args["setup_only"]:
 
             # Use Spack upstream
             if not is_windows() and args["upstream"] is not None:
-                env.use_spack_upstream()
+                phases.append(Phase("use_spack_upstream", env.use_spack_upstream, inputs=setup))
 
-            return 0
+            phases.append(Phase("done", lambda: 0, inputs=[p.name for p in phases]))
+            return phases, "done"
 
     # Create Spack Environment and setup Spack package repos
+    env_ready = setup
     if not is_windows() and not args["skip_setup_and_env"]:
-        env.create_spack_env()
+        phases.append(Phase("create_spack_env", env.create_spack_env,
+                            inputs=setup, outputs=["spack_env"], checkpoint=True,
+                            exists=lambda: env.read_spack_env_inputs() is not None))
+        env_ready = ["spack_env"]
 
         # Allow to end uberenv after Spack environment is ready
         if args["setup_and_env_only"]:
-            return 0
+            phases.append(Phase("done", lambda: 0, inputs=env_ready))
+            return phases, "done"
 
     ###########################################################
     # We now have an instance of our package manager configured,
@@ -1420,25 +4366,99 @@ def main():
     #
     ###########################################################
     if args["create_mirror"]:
-        return env.create_mirror()
-    else:
-        # Add mirror
-        if args["mirror"] is not None:
-            env.use_mirror()
+        phases.append(Phase("create_mirror", env.create_mirror, inputs=env_ready))
+        return phases, "create_mirror"
+
+    # When uberenv set up the Spack Environment in this run, the mirror and
+    # upstream are already part of it. Otherwise they are added to spack's
+    # defaults scope, which both rewrite, so keep them in order.
+    env_managed = not is_windows() and not args["skip_setup_and_env"]
+    configured = env_ready
+
+    # Add mirror
+    if args["mirror"] is not None and not env_managed:
+        phases.append(Phase("use_mirror", env.use_mirror, inputs=configured, checkpoint=True))
+        configured = ["use_mirror"]
+
+    # Use Spack upstream
+    if not is_windows() and args["upstream"] is not None and not env_managed:
+        phases.append(Phase("use_spack_upstream", env.use_spack_upstream, inputs=configured,
+                            checkpoint=True))
+        configured = ["use_spack_upstream"]
+
+    # Concretize the spack environment
+    if not is_windows():
+        phases.append(Phase("concretize_spack_env", env.concretize_spack_env, inputs=configured,
+                            checkpoint=True,
+                            exists=lambda: os.path.isfile(pjoin(env.spack_env_directory, "spack.lock"))))
+        configured = ["concretize_spack_env"]
+
+    # Bundle the concretized environment for an air-gapped machine
+    if not is_windows() and args["export_bundle"] is not None:
+        phases.append(Phase("export_bundle", env.export_bundle, inputs=configured))
+        return phases, "export_bundle"
+
+    # Show the spec for what will be built
+    phases.append(Phase("show_info", env.show_info, inputs=configured))
+
+    # Install
+    phases.append(Phase("install", env.install, inputs=["show_info"]))
+    return phases, "install"
+
+
+def main():
+    """
+    Clones and runs a package manager to setup third_party libs.
+    Also creates a host-config.cmake file that can be used by our project.
+    """
+
+    print_uberenv_python_info()
+
+    # parse args from command line
+    args, extra_args = parse_args()
+
+    # project options
+    args["project_json"] = find_project_config(args)
+
+    if args["log"] is not None:
+        open_log(pabs(args["log"]))
 
-        # Use Spack upstream
-        if not is_windows() and args["upstream"] is not None:
-            env.use_spack_upstream()
+    if args["trace"] is not None:
+        tracer.open(pabs(args["trace"]))
 
-        # Concretize the spack environment
-        if not is_windows():
-            env.concretize_spack_env()
+    # Initialize the environment -- use vcpkg on windows, spack otherwise
+    env = SpackEnv(args, extra_args) if not is_windows() else VcpkgEnv(args, extra_args)
 
-        # Show the spec for what will be built
-        env.show_info()
+    # Setup the necessary paths and directories
+    env.setup_paths_and_dirs()
+
+    # Report the resources used by all commands when uberenv exits
+    atexit.register(resource_usage.report, pjoin(env.dest_dir, ".uberenv_rusage.json"))
+
+    # Stop right away if a previous run already did everything asked for,
+    # options that ask for more than the install always run
+    partial_run = any(args[opt] for opt in ("setup_only", "setup_and_env_only",
+                                            "create_mirror", "spack_clean",
+                                            "export_bundle", "repo_pull",
+                                            "save_setup_snapshot", "clean_caches"))
+    if not args["force"] and not partial_run and env.install_is_current():
+        return 0
+
+    # Go to package manager's destination
+    os.chdir(env.dest_dir)
 
-        # Install
-        return env.install()
+    # Run all phases, independent phases run concurrently. Completed phases
+    # are recorded in the prefix, so that --resume can skip them.
+    phases, final_phase = uberenv_phases(env, args)
+    state = PhaseState(pjoin(env.dest_dir, ".uberenv_phases.json"))
+    graph = PhaseGraph(phases,
+                       max_workers=env.uberenv_jobs(),
+                       state=state,
+                       inputs_hash=env.phase_inputs_hash(),
+                       resume=args["resume"])
+    with tracer.span("uberenv", "run"):
+        results = graph.run()
+    return results[final_phase]
 
 if __name__ == "__main__":
     sys.exit(main())